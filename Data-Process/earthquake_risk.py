@@ -1,64 +1,96 @@
-from copy import deepcopy
 import json
 import os
-from multiprocessing import Pool, current_process
 
-from tqdm import tqdm
-import shapely
-import shapely.ops
+import numpy as np
 
 from utils import *
+from geo_utils import *
+from vector_tiles import *
+
+# bump the version of a stage when its computation changes
+DANGER_SLOPE_STAGE_VERSION = 1
+OLD_HOUSE_STAGE_VERSION = 1
+LIQUEFACTION_STAGE_VERSION = 1
+VULNERABILITY_STAGE_VERSION = 1
+
+VILLAGE_BORDERS_GEOJSON_PATH = (
+    '../Taipei-City-Dashboard-FE/public/mapData/taipei_village.geojson'
+)
+DANGER_SLOPES_GEOJSON_PATH = 'data/patrol_artificial_slope.geojson'
+OLD_HOUSE_GEOJSON_PATH = 'data/building_age.geojson'
+LIQUEFACTION_GEOJSON_PATH = 'data/work_soil_liquefaction.geojson'
+
+def normalize_series(series: pd.Series) -> pd.Series:
+    min_val = series.min()
+    max_val = series.max()
+    return ((series - min_val) / (max_val - min_val)).round(3)
+
+def get_danger_slope_vuln_point(vnames, village_borders):
+    # 第五類: 無異常徵兆
+    # 第四類: 有輕微徵兆
+    # 第三類: 有明顯徵兆
+    # 第二類: 有潛在危險
+    # 第一類: 有立即危險之虞
+    danger_slopes, _ = read_geojson_geometries(
+        DANGER_SLOPES_GEOJSON_PATH,
+        where=lambda properties: properties['level'] != '第五類',
+        drop_z=True # fix coordinate
+    )
 
-def get_vuln_points(arg_dict):
-    village_borders_shapes = arg_dict['village_borders_shapes']
-    old_house_points = arg_dict['old_house_points']
-    local_vuln_point = {
-        vname: 0
-        for vname in village_borders_shapes
-    }
-    v_start = round(current_process()._identity[0] / 8 * len(village_borders_shapes))
-    v_items = list(village_borders_shapes.items())
-    v_items = v_items[v_start:] + v_items[:v_start]
-    for old_house in tqdm(
-            old_house_points,
-            ncols=100,
-            position=(current_process()._identity[0]),
-            leave=False):
-        for vname, vborder in list(village_borders_shapes.items()):
-            # check contains
-            if shapely.contains(vborder, old_house):
-                local_vuln_point[vname] += 1
-                break
-    
-    return local_vuln_point
-
-def normalize_dict_value(counter):
-    max_val = max(counter.values())
-    min_val = min(counter.values())
-    return {
-        k: round((v - min_val) / (max_val - min_val), 3)
-        for k, v in counter.items()
-    }
+    danger_slope_lengths = length_weighted_overlay(
+        village_borders,
+        danger_slopes
+    )
+    record_stage(rows_in=len(danger_slopes), rows_out=len(vnames))
+    return normalize_series(pd.Series(danger_slope_lengths, index=vnames))
 
-if __name__ == '__main__':
-    ### Get village borders
+def get_old_house_vuln_point(vnames, village_borders):
+    old_house_points, _ = read_geojson_geometries(
+        OLD_HOUSE_GEOJSON_PATH,
+        where=lambda properties: properties['age_2021'] > 20
+    )
 
-    village_borders_geojson_path = (
-        '../Taipei-City-Dashboard-FE/public/mapData/taipei_village.geojson'
+    # for test
+    # old_house_points = old_house_points[:10000]
+
+    old_house_counts = count_points_in_polygons(
+        village_borders,
+        old_house_points,
+        processes=int(ENVS.get('DATA_PROCESS_WORKERS', 1))
     )
-    with open(village_borders_geojson_path, 'r') as village_borders_geojson_file:
-        village_borders_geojson = json.load(village_borders_geojson_file)
+    record_stage(rows_in=len(old_house_points), rows_out=len(vnames))
+    # normalization
+    return normalize_series(pd.Series(old_house_counts, index=vnames))
 
-    village_borders_shapes = {
-        feature['properties']['VNAME']: shapely.from_geojson(json.dumps(feature))
-        for feature in village_borders_geojson['features']
+def get_liquefaction_vuln_point(vnames, village_borders):
+    liquefaction_class_weight = {
+        '高': 3,
+        '中': 2,
+        '低': 1,
     }
-    vnames = list(village_borders_shapes.keys())
-    village_base_geojson = village_borders_geojson
-    for feature in village_base_geojson['features']:
-        feature['properties'] = {
-            'VNAME': feature['properties']['VNAME']
-        }
+    liquefaction_polygons, liquefaction_properties = read_geojson_geometries(
+        LIQUEFACTION_GEOJSON_PATH,
+        property_names=['class']
+    )
+    liquefaction_weights = np.array([
+        liquefaction_class_weight[cls]
+        for cls in liquefaction_properties['class']
+    ])
+
+    liquefaction_scores = area_weighted_overlay(
+        village_borders,
+        liquefaction_polygons,
+        liquefaction_weights
+    )
+    record_stage(rows_in=len(liquefaction_polygons), rows_out=len(vnames))
+    return normalize_series(pd.Series(liquefaction_scores, index=vnames))
+
+if __name__ == '__main__':
+    ### Get village borders
+
+    village_layer = VillageBaseLayer(VILLAGE_BORDERS_GEOJSON_PATH)
+    vnames = village_layer.vnames
+    village_borders = village_layer.geometries
 
     ### Vulnerabiliies
 
@@ -68,199 +100,95 @@ if __name__ == '__main__':
         + village_vuln_geojson_filename
         + '.geojson'
     )
-    if os.path.exists(village_vuln_geojson_path):
+    vuln_input_paths = [
+        DANGER_SLOPES_GEOJSON_PATH,
+        OLD_HOUSE_GEOJSON_PATH,
+        LIQUEFACTION_GEOJSON_PATH,
+    ]
+    missing_input_paths = [
+        path for path in vuln_input_paths if not os.path.exists(path)
+    ]
+    if len(missing_input_paths) != 0:
+        print(
+            'WARNING: missing ' + ', '.join(missing_input_paths)
+            + f', use the published {village_vuln_geojson_path}, '
+            'which may be stale'
+        )
         with open(village_vuln_geojson_path) as f:
             village_vuln_geojson = json.load(f)
-            village_vuln_point = {
+            village_vuln_point = pd.Series({
                 feature['properties']['VNAME']: feature['properties']['vulnerability']
                 for feature in village_vuln_geojson['features']
-            }
+            })
     else:
-        village_vuln_point = {
-            vname: 0
-            for vname in vnames
-        }
-
-        ####### Dangerous Slope
-
-        danger_slopes_geojson_path = 'data/patrol_artificial_slope.geojson'
-        with open(danger_slopes_geojson_path) as danger_slopes_geojson_file:
-            danger_slopes_geojson = json.load(danger_slopes_geojson_file)
-        # fix coordinate
-        for feature in danger_slopes_geojson['features']:
-            feature['geometry']['coordinates'] = [
-                [x, y]
-                for x, y, z in feature['geometry']['coordinates']
-            ]
-
-        # 第五類: 無異常徵兆
-        # 第四類: 有輕微徵兆
-        # 第三類: 有明顯徵兆
-        # 第二類: 有潛在危險
-        # 第一類: 有立即危險之虞
-        danger_slopes = [
-            shapely.from_geojson(json.dumps(feature))
-            for feature in danger_slopes_geojson['features']
-            if feature['properties']['level'] != '第五類'
-        ]
-
-        danger_slope_vuln_point = {
-            vname: 0
-            for vname in vnames
-        }
-        for vname in tqdm(vnames, ncols=100):
-            vborder = village_borders_shapes[vname]
-            for slope in danger_slopes:
-                # check intersect
-                if not shapely.intersects(slope, vborder):
-                    continue
-                # split the slope line with the border of village 
-                for split_line in shapely.ops.split(slope, vborder).geoms:
-                    if shapely.contains(vborder, split_line):
-                        danger_slope_vuln_point[vname] += shapely.length(split_line)
-                        break
-        danger_slope_vuln_point = normalize_dict_value(danger_slope_vuln_point)
-
-        ###### Old House
-
-        old_house_geojson_path = (
-            'data/building_age.geojson'
+        stage_cache = StageCache()
+
+        # the stage results are cached as json, so pass them as dicts
+        danger_slope_vuln_point, danger_slope_key = stage_cache.run(
+            'earthquake_danger_slope',
+            lambda: get_danger_slope_vuln_point(vnames, village_borders).to_dict(),
+            input_paths=[VILLAGE_BORDERS_GEOJSON_PATH, DANGER_SLOPES_GEOJSON_PATH],
+            version=DANGER_SLOPE_STAGE_VERSION
+        )
+        old_house_vuln_point, old_house_key = stage_cache.run(
+            'earthquake_old_house',
+            lambda: get_old_house_vuln_point(vnames, village_borders).to_dict(),
+            input_paths=[VILLAGE_BORDERS_GEOJSON_PATH, OLD_HOUSE_GEOJSON_PATH],
+            version=OLD_HOUSE_STAGE_VERSION
+        )
+        liquefaction_vuln_point, liquefaction_key = stage_cache.run(
+            'earthquake_liquefaction',
+            lambda: get_liquefaction_vuln_point(vnames, village_borders).to_dict(),
+            input_paths=[VILLAGE_BORDERS_GEOJSON_PATH, LIQUEFACTION_GEOJSON_PATH],
+            version=LIQUEFACTION_STAGE_VERSION
         )
-        with open(old_house_geojson_path) as old_house_geojson_file:
-            old_house_geojson = json.load(old_house_geojson_file)
-
-        old_house_points = [
-            shapely.from_geojson(json.dumps(feature))
-            for feature in old_house_geojson["features"]
-            if feature["properties"]["age_2021"] > 20 and feature["geometry"] is not None
-        ]
-
-        # for test
-        # old_house_points = old_house_points[:10000]
-
-        old_house_vuln_point = {
-            vname: 0
-            for vname in vnames
-        }
-        with Pool(8) as p:
-            chunk_length = len(old_house_points) // 8
-            old_house_points_chunks = [
-                old_house_points[i:i+chunk_length]
-                for i in range(0, len(old_house_points), chunk_length)
-            ]
-            args_dict_list = [
-                {
-                    'village_borders_shapes': village_borders_shapes,
-                    'old_house_points': chunk
-                }
-                for chunk in old_house_points_chunks
-            ]
-            chunks_vuln_points = list(
-                p.imap_unordered(get_vuln_points, args_dict_list)
-            )
-            # print(chunks_vuln_points)
-        for chunk_vuln_point in chunks_vuln_points:
-            for vname in vnames:
-                old_house_vuln_point[vname] += chunk_vuln_point[vname]
-        # normalization
-        old_house_vuln_point = normalize_dict_value(old_house_vuln_point)
-    
-        ###### Liquefaction
-
-        liquefaction_geojson_path = 'data/work_soil_liquefaction.geojson'
-        with open(liquefaction_geojson_path) as liquefaction_geojson_file:
-            liquefaction_geojson = json.load(liquefaction_geojson_file)
-        liquefaction_polygon_class = {
-            shapely.from_geojson(json.dumps(feature)): feature['properties']['class']
-            for feature in liquefaction_geojson['features']
-        }
-
-        liquefaction_vuln_point = {
-            vname: 0
-            for vname in vnames
-        }
-        for vname in vnames:
-            vborder = village_borders_shapes[vname]
-            vborder_area = shapely.area(vborder)
-            for polygon, cls in liquefaction_polygon_class.items():
-                if not shapely.intersects(vborder, polygon):
-                    continue
-                intersection_area = shapely.area(
-                    shapely.intersection(vborder, polygon)
-                )
-                if cls == '高':
-                    weight = 3
-                elif cls == '中':
-                    weight = 2
-                elif cls == '低':
-                    weight = 1
-                else:
-                    ValueError()
-                liquefaction_vuln_point[vname] += (
-                    weight * intersection_area / vborder_area
-                )
-        liquefaction_vuln_point = normalize_dict_value(liquefaction_vuln_point)
 
         ### Combine into vulnerability
 
-        village_vuln_point = {
-            vname: (danger_slope_vuln_point[vname]
-                + old_house_vuln_point[vname]
-                + liquefaction_vuln_point[vname]
-            )
-            for vname in vnames
-        }
-        village_vuln_point = normalize_dict_value(village_vuln_point)
-        
+        village_vuln_point, _ = stage_cache.run(
+            'earthquake_vulnerability',
+            lambda: normalize_series(
+                pd.Series(danger_slope_vuln_point)
+                + pd.Series(old_house_vuln_point)
+                + pd.Series(liquefaction_vuln_point)
+            ).to_dict(),
+            upstream_keys=[danger_slope_key, old_house_key, liquefaction_key],
+            version=VULNERABILITY_STAGE_VERSION
+        )
+        village_vuln_point = pd.Series(village_vuln_point)
+
         # save to geojson in front end
-        village_vuln_geojson = deepcopy(village_base_geojson)
-        for feature in village_vuln_geojson['features']:
-            vname = feature['properties']['VNAME']
-            feature['properties']['vulnerability'] = village_vuln_point[vname]
-        with open(village_vuln_geojson_path, 'w') as f:
-            json.dump(village_vuln_geojson, f)
+        village_vuln_geojson = write_village_layer(
+            village_layer,
+            {'vulnerability': village_vuln_point[vnames].tolist()},
+            village_vuln_geojson_path,
+            compress=['gz']
+        )
+        write_map_data_tiles(
+            village_vuln_geojson, village_vuln_geojson_filename
+        )
 
     ### Population density
 
     village_pop_csv_path = 'data/111_villages_populations.csv'
-    with open(village_pop_csv_path) as village_pop_csv_file:
-        # we only want total population for each vil.
-        village_pop_lines = village_pop_csv_file.readlines()[4::3]
-        # we only want the 3rd and 5th column: name and total population
-        village_pop_lines_splited = [
-            line.split(',', maxsplit=6)
-            for line in village_pop_lines
-        ]
-    village_pop = dict([
-        (line_splits[3], int(line_splits[5]))
-        for line_splits in village_pop_lines_splited
-    ])
-    village_pop['糖蔀里'] = village_pop['糖?里']
+    village_names, village_totals = read_village_populations(
+        iter_file_chunks(village_pop_csv_path), encoding='utf-8'
+    )
+    village_pop = pd.Series(dict(zip(village_names, village_totals)))
 
-    # directly read from front end geojson
-    taipei_village_geojson_path = (
-        '../Taipei-City-Dashboard-FE/public/mapData/'
-        'taipei_village.geojson'
+    village_area = pd.Series(
+        village_layer.properties['AREA'].to_numpy() / 1_000_000, # m^2 to km^2
+        index=vnames
     )
-    with open(taipei_village_geojson_path) as taipei_village_geojson_file:
-        taipei_village_geojson = json.load(taipei_village_geojson_file)
-    village_area = {
-        feature['properties']['VNAME']: (
-            feature['properties']['AREA'] / 1_000_000 # from m^2 to km^2
-        )
-        for feature in taipei_village_geojson['features']
-    }
+    # VNAME is not unique (新安里, 中央里), keep the last one like the
+    # village dicts do, so that all the frames below have unique indices
+    village_area = village_area[~village_area.index.duplicated(keep='last')]
     # calculate the polulation density
-    village_pop_density = {
-        vname: round(village_pop[vname] / village_area[vname], 2)
-        for vname in vnames
-    }
+    village_pop_density = (
+        village_pop[village_area.index] / village_area
+    ).round(2)
     # normalization
-    village_pop_density_index = {
-        vname: village_pop_density[vname] / max(village_pop_density.values())
-        for vname in vnames
-    }
-    # print(village_pop_density_index)
+    village_pop_density_index = village_pop_density / village_pop_density.max()
 
     ### Risk index
 
@@ -272,16 +200,13 @@ if __name__ == '__main__':
         ('6強', 2/3),
         ('7級', 5/6),
     ]
-    village_risk_indices = {
-        intensity: {
-            vname: (village_pop_density_index[vname]
-                + village_vuln_point[vname]
-                + weight
-            ) / 3
-            for vname in vnames
-        }
+    # one column per intensity, indexed by VNAME
+    village_risk_indices = pd.DataFrame({
+        intensity: (
+            village_pop_density_index + village_vuln_point + weight
+        ) / 3
         for intensity, weight in quake_intensity_weight
-    }
+    })
 
     # save to geojson in front end
     village_risk_index_geojson_filename = 'taipei_village_earthquake_risk_index'
@@ -290,34 +215,33 @@ if __name__ == '__main__':
         + village_risk_index_geojson_filename
         + '.geojson'
     )
-    village_risk_index_geojson = deepcopy(village_base_geojson)
-    for feature in village_risk_index_geojson['features']:
-        vname = feature['properties']['VNAME']
-        for intensity, _weight in quake_intensity_weight:
-            feature['properties'][intensity] = round(
-                village_risk_indices[intensity][vname],
-                5
-            )
-    with open(village_risk_index_geojson_path, 'w') as f:
-        json.dump(village_risk_index_geojson, f)
+    village_risk_index_geojson = write_village_layer(
+        village_layer,
+        {
+            intensity: village_risk_indices[intensity][vnames].round(5).tolist()
+            for intensity, _weight in quake_intensity_weight
+        },
+        village_risk_index_geojson_path,
+        compress=['gz']
+    )
+    write_map_data_tiles(
+        village_risk_index_geojson, village_risk_index_geojson_filename
+    )
 
     # Init data table
 
     village_risk_index_table_name = 'village_earthquake_risk_index'
-    csv_buffer = 'vname,' + ','.join([
-        f'intensity_{intensity}'
+    village_risk_index_df = village_risk_indices.rename(columns={
+        intensity: f'intensity_{intensity}'
         for intensity, _ in quake_intensity_weight
-    ]) + '\n'
-    for vname in vnames:
-        csv_buffer += ','.join([vname] + [
-            str(village_risk_indices[intensity][vname])
-            for intensity, _ in quake_intensity_weight
-        ]) + '\n'
-    init_data_table_with_csv_buffer(
-        csv_buffer.encode(),
+    })
+    village_risk_index_df.insert(0, 'vname', village_risk_indices.index)
+    init_data_table_with_df(
+        village_risk_index_df,
         village_risk_index_table_name,
         on_conflict_do='update',
-        constraint_fields=['vname']
+        constraint_fields=['vname'],
+        load_method='swap'
     )
 
     # Set Manager DB
@@ -337,46 +261,43 @@ if __name__ == '__main__':
         [0.5, '#7777ee'],
         [1,   '#0000ff'],
     ]
-    with manager_engine.connect() as conn:
-        ComponentManager(
-            id=vuln_component_id,
-            index=vuln_component_index,
-            name='房屋與地質災害潛勢指數',
-            query_type='map_legend',
-            query_chart=vuln_query_chart,
-            map_config_ids=[vuln_component_id],
-            time_from='static',
-        ).insert(conn, on_conflict_do='update')
-
-        ComponentChartConfig(
-            index=vuln_component_index,
-            types=['MapLegend'],
-            color=[c for _v, c in vuln_fill_color_stops],
-            unit='指數'
-        ).insert(conn, on_conflict_do='update')
-
-        MapConfig(
-            id=vuln_component_id,
-            index=village_vuln_geojson_filename,
-            title='房屋與地質災害潛勢指數',
-            type='fill',
-            paint={
-                'fill-color': {
-                    'property': 'vulnerability',
-                    'stops': vuln_fill_color_stops
-                },
-                'fill-opacity': 0.3
+    registry = ComponentRegistry()
+    registry.add(ComponentManager(
+        id=vuln_component_id,
+        index=vuln_component_index,
+        name='房屋與地質災害潛勢指數',
+        query_type='map_legend',
+        query_chart=vuln_query_chart,
+        map_config_ids=[vuln_component_id],
+        time_from='static',
+    ))
+
+    registry.add(ComponentChartConfig(
+        index=vuln_component_index,
+        types=['MapLegend'],
+        color=[c for _v, c in vuln_fill_color_stops],
+        unit='指數'
+    ))
+
+    registry.add(MapConfig(
+        id=vuln_component_id,
+        index=village_vuln_geojson_filename,
+        title='房屋與地質災害潛勢指數',
+        type='fill',
+        paint={
+            'fill-color': {
+                'property': 'vulnerability',
+                'stops': vuln_fill_color_stops
             },
-            property=JsonList(
-                {'key': 'VNAME', 'name': '里名'},
-                {'key': 'vulnerability', 'name': '房屋與地質災害潛勢指數'}
-            )
-        ).insert(conn, on_conflict_do='update')
-
-        add_component_into_dashboard(
-            conn, vuln_component_id, 'hackathon-components'
+            'fill-opacity': 0.3
+        },
+        property=JsonList(
+            {'key': 'VNAME', 'name': '里名'},
+            {'key': 'vulnerability', 'name': '房屋與地質災害潛勢指數'}
         )
-        conn.commit()
+    ))
+
+    registry.add_to_dashboard('hackathon-components', vuln_component_id)
 
     risk_component_id = 88
     risk_component_index = 'village_earthquake_risk_index'
@@ -398,55 +319,59 @@ if __name__ == '__main__':
         WHEN (y_axis = '高') THEN 3
     END
     """.strip()
-    # with get_data_engine().connect() as conn:
-    #     print(conn.execute(text(risk_query_chart)).all())
+    # the data only changes when this script runs, so save the chart
+    with get_data_engine().connect() as conn:
+        risk_query_chart = materialize_query_clause(
+            conn, f'{village_risk_index_table_name}_chart', risk_query_chart
+        )
+        conn.commit()
     risk_fill_color_stops = [
         [0,    '#dddddd'],
         [0.25, '#ee7777'],
         [0.5,  '#ff0000'],
     ]
-    with manager_engine.connect() as conn:
-        ComponentManager(
-            id=risk_component_id,
-            index=risk_component_index,
-            name='地震災害風險評估指數',
-            query_type='three_d',
-            query_chart=risk_query_chart,
-            map_config_ids=[
-                risk_component_id + i
-                for i in range(len(quake_intensity_weight))
-            ],
-            map_filter={'mode': 'byLayer'},
-            time_from='static',
-        ).insert(conn, on_conflict_do='update')
-
-        ComponentChartConfig(
-            index=risk_component_index,
-            types=['BarPercentChart'],
-            color=[c for v, c in risk_fill_color_stops],
-            unit='個'
-        ).insert(conn, on_conflict_do='update')
-
-        for i, (intensity, _) in enumerate(quake_intensity_weight):
-            MapConfig(
-                id=risk_component_id+i,
-                index=village_risk_index_geojson_filename,
-                title=intensity,
-                type='fill',
-                paint={
-                    'fill-color': {
-                        'property': intensity,
-                        'stops': risk_fill_color_stops
-                    },
-                    'fill-opacity': 0.3
+    registry.add(ComponentManager(
+        id=risk_component_id,
+        index=risk_component_index,
+        name='地震災害風險評估指數',
+        query_type='three_d',
+        query_chart=risk_query_chart,
+        map_config_ids=[
+            risk_component_id + i
+            for i in range(len(quake_intensity_weight))
+        ],
+        map_filter={'mode': 'byLayer'},
+        time_from='static',
+    ))
+
+    registry.add(ComponentChartConfig(
+        index=risk_component_index,
+        types=['BarPercentChart'],
+        color=[c for v, c in risk_fill_color_stops],
+        unit='個'
+    ))
+
+    for i, (intensity, _) in enumerate(quake_intensity_weight):
+        registry.add(MapConfig(
+            id=risk_component_id+i,
+            index=village_risk_index_geojson_filename,
+            title=intensity,
+            type='fill',
+            paint={
+                'fill-color': {
+                    'property': intensity,
+                    'stops': risk_fill_color_stops
                 },
-                property=JsonList(
-                    {'key': 'VNAME', 'name': '里名'},
-                    {'key': intensity, 'name': '災害風險評估指數'}
-                )
-            ).insert(conn, on_conflict_do='update')
-
-        add_component_into_dashboard(
-            conn, risk_component_id, 'hackathon-components'
-        )
+                'fill-opacity': 0.3
+            },
+            property=JsonList(
+                {'key': 'VNAME', 'name': '里名'},
+                {'key': intensity, 'name': '災害風險評估指數'}
+            )
+        ))
+
+    registry.add_to_dashboard('hackathon-components', risk_component_id)
+
+    with manager_engine.connect() as conn:
+        registry.sync(conn)
         conn.commit()
@@ -0,0 +1,509 @@
+import hashlib
+import json
+from multiprocessing import Pool
+import os
+import tempfile
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import shapely
+import shapely.ops
+
+
+### GEOMETRY FILES
+
+def save_geometries(path_prefix: str, geometries: np.ndarray) -> None:
+    """Save geometries as one flat WKB buffer plus offsets, so that other
+    processes can memory-map them instead of unpickling.
+    """
+    wkbs = shapely.to_wkb(geometries)
+    offsets = np.zeros(len(wkbs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(wkb) for wkb in wkbs])
+    np.save(
+        path_prefix + '_wkb.npy',
+        np.frombuffer(b''.join(wkbs), dtype=np.uint8)
+    )
+    np.save(path_prefix + '_offsets.npy', offsets)
+
+def load_geometries(
+        path_prefix: str,
+        start: int = 0,
+        stop: Optional[int] = None) -> np.ndarray:
+    """Load the geometries `[start:stop]` saved by `save_geometries`. Only
+    the requested part of the memory-mapped buffer is read.
+    """
+    wkb_buffer = np.load(path_prefix + '_wkb.npy', mmap_mode='r')
+    offsets = np.load(path_prefix + '_offsets.npy', mmap_mode='r')
+    if stop is None:
+        stop = len(offsets) - 1
+    wkbs = np.array([
+        wkb_buffer[offsets[i]:offsets[i+1]].tobytes()
+        for i in range(start, stop)
+    ], dtype=object)
+    return shapely.from_wkb(wkbs)
+
+
+### SPATIAL JOINS
+
+# state of the pool workers, set once by init_assign_worker
+worker_polygons: Optional[np.ndarray] = None
+worker_points_path_prefix: Optional[str] = None
+
+def assign_with_polygons(
+        polygons: np.ndarray,
+        points: np.ndarray) -> np.ndarray:
+    # query the polygons against a tree of the points, so that each polygon
+    # is prepared once instead of testing every point against raw polygons
+    polygon_indices, point_indices = shapely.STRtree(points).query(
+        polygons, predicate='contains'
+    )
+    order = np.lexsort((polygon_indices, point_indices))
+    point_indices = point_indices[order]
+    polygon_indices = polygon_indices[order]
+    _, first_match = np.unique(point_indices, return_index=True)
+    assignment = np.full(len(points), -1, dtype=np.intp)
+    assignment[point_indices[first_match]] = polygon_indices[first_match]
+    return assignment
+
+def init_assign_worker(data_dir: str) -> None:
+    global worker_polygons, worker_points_path_prefix
+    worker_polygons = load_geometries(os.path.join(data_dir, 'polygons'))
+    shapely.prepare(worker_polygons)
+    worker_points_path_prefix = os.path.join(data_dir, 'points')
+
+def assign_chunk(start: int, stop: int) -> np.ndarray:
+    points = load_geometries(worker_points_path_prefix, start, stop)
+    return assign_with_polygons(worker_polygons, points)
+
+def assign_points_to_polygons(
+        polygons: np.ndarray,
+        points: np.ndarray,
+        processes: Optional[int] = None,
+        chunk_size: int = 100_000) -> np.ndarray:
+    """Return the index of the polygon that contains each point, or -1 if no
+    polygon contains it. When polygons overlap, the one with the smallest
+    index wins, the same as a linear scan that stops at the first match.
+
+    With `processes` > 1 the points are split by index into chunks of
+    `chunk_size` and assigned by a worker pool. The geometries are written
+    once to memory-mapped WKB files, each worker loads the polygons in its
+    initializer and reads only its own chunk of points, so no geometry is
+    pickled per task.
+    """
+    if processes is None or processes <= 1:
+        return assign_with_polygons(polygons, points)
+    with tempfile.TemporaryDirectory() as data_dir:
+        save_geometries(os.path.join(data_dir, 'polygons'), polygons)
+        save_geometries(os.path.join(data_dir, 'points'), points)
+        chunk_ranges = [
+            (start, min(start + chunk_size, len(points)))
+            for start in range(0, len(points), chunk_size)
+        ]
+        with Pool(
+                processes,
+                initializer=init_assign_worker,
+                initargs=(data_dir,)) as pool:
+            assignment_chunks = pool.starmap(assign_chunk, chunk_ranges)
+    if len(assignment_chunks) == 0:
+        return np.full(0, -1, dtype=np.intp)
+    return np.concatenate(assignment_chunks)
+
+def count_points_in_polygons(
+        polygons: np.ndarray,
+        points: np.ndarray,
+        processes: Optional[int] = None) -> np.ndarray:
+    """Count the points (or any features) that lie within each polygon,
+    e.g. the number of buildings in each village.
+    """
+    assignment = assign_points_to_polygons(polygons, points, processes)
+    return np.bincount(
+        assignment[assignment >= 0],
+        minlength=len(polygons)
+    )
+
+
+### OVERLAYS
+
+def intersecting_pairs(
+        polygons: np.ndarray,
+        geometries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the index pairs of polygons and geometries that intersect,
+    sorted by polygon index and then by geometry index.
+    """
+    tree = shapely.STRtree(geometries)
+    polygon_indices, geometry_indices = tree.query(
+        polygons, predicate='intersects'
+    )
+    order = np.lexsort((geometry_indices, polygon_indices))
+    return polygon_indices[order], geometry_indices[order]
+
+def area_weighted_overlay(
+        polygons: np.ndarray,
+        overlay_polygons: np.ndarray,
+        weights: np.ndarray) -> np.ndarray:
+    """For each polygon, sum up `weight * intersection area / polygon area`
+    over the overlay polygons that intersect it.
+    """
+    polygon_indices, overlay_indices = intersecting_pairs(
+        polygons, overlay_polygons
+    )
+    intersection_areas = shapely.area(shapely.intersection(
+        polygons[polygon_indices], overlay_polygons[overlay_indices]
+    ))
+    scores = np.zeros(len(polygons))
+    np.add.at(
+        scores,
+        polygon_indices,
+        weights[overlay_indices] * intersection_areas
+            / shapely.area(polygons[polygon_indices])
+    )
+    return scores
+
+def first_contained_piece_length(
+        polygon: shapely.Geometry,
+        line: shapely.Geometry) -> float:
+    """Split the line with the polygon border and return the length of the
+    first piece inside the polygon.
+    """
+    for piece in shapely.ops.split(line, polygon).geoms:
+        if shapely.contains(polygon, piece):
+            return shapely.length(piece)
+    return 0.0
+
+def length_weighted_overlay(
+        polygons: np.ndarray,
+        lines: np.ndarray) -> np.ndarray:
+    """For each polygon, sum up the length of the lines inside it. A line
+    that enters a polygon more than once only counts its first piece, see
+    `first_contained_piece_length`.
+    """
+    polygon_indices, line_indices = intersecting_pairs(polygons, lines)
+    pair_polygons = polygons[polygon_indices]
+    pair_lines = lines[line_indices]
+    pieces = shapely.intersection(pair_lines, pair_polygons)
+    lengths = shapely.length(pieces)
+    # most pairs cross the border at most once and give a single piece, the
+    # rest fall back to the split
+    is_single_piece = (
+        (shapely.get_type_id(pieces) == shapely.GeometryType.LINESTRING)
+        & shapely.contains(pair_polygons, pieces)
+    )
+    for i in np.flatnonzero(~is_single_piece):
+        lengths[i] = first_contained_piece_length(
+            pair_polygons[i], pair_lines[i]
+        )
+    scores = np.zeros(len(polygons))
+    np.add.at(scores, polygon_indices, lengths)
+    return scores
+
+
+### TOPOLOGY
+
+def quantized_rings(
+        polygons: np.ndarray,
+        translate: Tuple[float, float],
+        scale: float) -> Tuple[List[np.ndarray], np.ndarray, np.ndarray]:
+    """Return the rings of the polygons as open integer coordinates on the
+    grid of `scale` from `translate`, without repeated points, and the index
+    of the part and of the polygon of each ring.
+    """
+    parts, polygon_indices = shapely.get_parts(polygons, return_index=True)
+    rings, part_indices = shapely.get_rings(parts, return_index=True)
+    coords, ring_indices = shapely.get_coordinates(rings, return_index=True)
+    coords = np.round((coords - translate) / scale).astype(np.int64)
+    ring_starts = np.searchsorted(ring_indices, np.arange(len(rings)))
+    ring_coords = []
+    ring_stops = np.append(ring_starts[1:], len(coords))
+    for start, stop in zip(ring_starts, ring_stops):
+        # drop the closing point and the points that collapsed on the grid
+        ring = coords[start:stop - 1]
+        is_moved = np.any(ring != np.roll(ring, 1, axis=0), axis=1)
+        ring_coords.append(ring[is_moved])
+    return ring_coords, part_indices, polygon_indices[part_indices]
+
+def find_junctions(ring_coords: List[np.ndarray]) -> np.ndarray:
+    """Return the keys of the points where rings meet or part, see
+    `point_keys`. A point is a junction when it has different neighbors in
+    two of the rings that pass it, like the ends of a border shared by two
+    villages.
+    """
+    keys = np.concatenate([point_keys(ring) for ring in ring_coords])
+    previous_keys = np.concatenate([
+        point_keys(np.roll(ring, 1, axis=0)) for ring in ring_coords
+    ])
+    next_keys = np.concatenate([
+        point_keys(np.roll(ring, -1, axis=0)) for ring in ring_coords
+    ])
+    # the neighbors of a point, regardless of the direction of the ring
+    neighbors = np.unique(np.column_stack([
+        keys,
+        np.minimum(previous_keys, next_keys),
+        np.maximum(previous_keys, next_keys)
+    ]), axis=0)
+    point_keys_of_neighbors, neighbor_counts = np.unique(
+        neighbors[:, 0], return_counts=True
+    )
+    return point_keys_of_neighbors[neighbor_counts > 1]
+
+def point_keys(coords: np.ndarray) -> np.ndarray:
+    """Pack non-negative integer coordinates below 2^31 into one integer."""
+    return (coords[:, 0] << 31) | coords[:, 1]
+
+def build_topology(
+        polygons: np.ndarray,
+        precision: int = 6) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Encode polygons as TopoJSON, where each border shared by two
+    polygons is stored once as an arc. The coordinates are quantized to
+    `precision` decimal places, like `write_geojson`, and the arcs are
+    delta-encoded.
+
+    The rings are cut into arcs at the junctions, see `find_junctions`. An
+    arc that runs along an earlier one in the opposite direction, like the
+    border of two neighboring villages, refers to it as `~index`.
+
+    Return the Topology without objects and the TopoJSON geometries, with
+    the same types as the polygons.
+    """
+    min_x, min_y, max_x, max_y = shapely.total_bounds(polygons)
+    scale = 10 ** -precision
+    # on the grid, so that the points are the same as rounded in geojson,
+    # and below the bounds, so that the quantized points are not negative
+    translate = (
+        round(np.floor(min_x / scale) * scale, precision),
+        round(np.floor(min_y / scale) * scale, precision),
+    )
+    ring_coords, part_indices, polygon_indices = quantized_rings(
+        polygons, translate, scale
+    )
+    junctions = find_junctions(ring_coords)
+
+    arcs: List[np.ndarray] = []
+    arc_indices: Dict[bytes, int] = dict()
+    def add_arc(arc: np.ndarray) -> int:
+        arc_key = point_keys(arc).tobytes()
+        if arc_key in arc_indices:
+            return arc_indices[arc_key]
+        reversed_key = point_keys(arc[::-1]).tobytes()
+        if reversed_key in arc_indices:
+            return ~arc_indices[reversed_key]
+        arc_indices[arc_key] = len(arcs)
+        arcs.append(arc)
+        return len(arcs) - 1
+
+    ring_arcs = []
+    for ring in ring_coords:
+        if len(ring) < 3:
+            ring_arcs.append(None)
+            continue
+        is_junction = np.isin(point_keys(ring), junctions)
+        if not np.any(is_junction):
+            # a ring that meets no other one is a closed arc, started at its
+            # smallest point, so that an island and the hole around it with
+            # the same points share it
+            ring = np.roll(ring, -np.argmin(point_keys(ring)), axis=0)
+            ring_arcs.append([add_arc(np.vstack([ring, ring[:1]]))])
+            continue
+        junction_positions = np.flatnonzero(is_junction)
+        ring = np.roll(ring, -junction_positions[0], axis=0)
+        ring = np.vstack([ring, ring[:1]])
+        cuts = np.append(
+            junction_positions - junction_positions[0], len(ring) - 1
+        )
+        ring_arcs.append([
+            add_arc(ring[start:stop + 1])
+            for start, stop in zip(cuts[:-1], cuts[1:])
+        ])
+
+    geometries = []
+    for polygon_index, polygon in enumerate(polygons):
+        part_arcs: Dict[int, list] = dict()
+        for ring_index in np.flatnonzero(polygon_indices == polygon_index):
+            part_arcs.setdefault(part_indices[ring_index], []).append(
+                ring_arcs[ring_index]
+            )
+        # the holes of a part that collapsed on the grid are dropped with it
+        polygon_arcs = [
+            [arcs for arcs in rings if arcs is not None]
+            for rings in part_arcs.values() if rings[0] is not None
+        ]
+        if shapely.get_type_id(polygon) == shapely.GeometryType.POLYGON:
+            geometries.append({
+                'type': 'Polygon',
+                'arcs': polygon_arcs[0] if len(polygon_arcs) != 0 else []
+            })
+        else:
+            geometries.append({'type': 'MultiPolygon', 'arcs': polygon_arcs})
+
+    topology = {
+        'type': 'Topology',
+        'bbox': [round(v, precision) for v in (min_x, min_y, max_x, max_y)],
+        'transform': {
+            'scale': [scale, scale],
+            'translate': list(translate),
+        },
+        'arcs': [
+            np.diff(arc, axis=0, prepend=[[0, 0]]).tolist() for arc in arcs
+        ],
+    }
+    return topology, geometries
+
+
+### VILLAGE BASE LAYER
+
+TAIPEI_VILLAGE_GEOJSON_PATH = (
+    '../Taipei-City-Dashboard-FE/public/mapData/taipei_village.geojson'
+)
+
+class VillageBaseLayer:
+    """The village borders of `taipei_village.geojson`, parsed once and
+    cached as WKB plus a properties table under `cache_dir`. The cache is
+    rebuilt when the hash of the geojson file changes.
+
+    Output layers are made with `to_geojson`, which attaches the given
+    property columns to the shared geometry dicts instead of copying the
+    coordinates for every layer.
+    """
+    def __init__(
+            self,
+            geojson_path: str = TAIPEI_VILLAGE_GEOJSON_PATH,
+            cache_dir: str = os.path.join('cache', 'village')):
+        with open(geojson_path, 'rb') as geojson_file:
+            source_hash = hashlib.sha256(geojson_file.read()).hexdigest()
+        geometries_path_prefix = os.path.join(cache_dir, 'geometries')
+        table_path = os.path.join(cache_dir, 'table.json')
+        table = None
+        if os.path.exists(table_path):
+            with open(table_path, 'r', encoding='utf-8') as table_file:
+                table = json.load(table_file)
+            if table['source_hash'] != source_hash:
+                table = None
+        if table is not None:
+            self.geometries = load_geometries(geometries_path_prefix)
+        else:
+            with open(geojson_path, 'r', encoding='utf-8') as geojson_file:
+                geojson = json.load(geojson_file)
+            table = {
+                'source_hash': source_hash,
+                'collection': {
+                    k: v for k, v in geojson.items() if k != 'features'
+                },
+                'properties': [
+                    feature['properties'] for feature in geojson['features']
+                ],
+            }
+            self.geometries = shapely.from_geojson(np.array([
+                json.dumps(feature['geometry'])
+                for feature in geojson['features']
+            ], dtype=object))
+            os.makedirs(cache_dir, exist_ok=True)
+            save_geometries(geometries_path_prefix, self.geometries)
+            with open(table_path, 'w', encoding='utf-8') as table_file:
+                json.dump(table, table_file, ensure_ascii=False)
+        self.geojson_path = geojson_path
+        self.collection: Dict[str, Any] = table['collection']
+        self.properties = pd.DataFrame(table['properties'])
+        self.vnames: List[str] = self.properties['VNAME'].tolist()
+        self._geometry_dicts: Optional[List[Dict[str, Any]]] = None
+        self._topojsons: Dict[int, Dict[str, Any]] = dict()
+
+    @property
+    def geometry_dicts(self) -> List[Dict[str, Any]]:
+        """The GeoJSON geometries, shared by all the layers made by
+        `to_geojson`. Do not modify them.
+        """
+        if self._geometry_dicts is None:
+            self._geometry_dicts = [
+                json.loads(geometry_str)
+                for geometry_str in shapely.to_geojson(self.geometries)
+            ]
+        return self._geometry_dicts
+
+    def to_geojson(
+            self,
+            property_columns: Dict[str, Sequence[Any]]) -> Dict[str, Any]:
+        """Make a FeatureCollection with the VNAME and the given columns,
+        each aligned with `vnames`, as the properties of the villages.
+        """
+        assert all(
+            len(column) == len(self.vnames)
+            for column in property_columns.values()
+        )
+        property_lists = {
+            k: list(column) for k, column in property_columns.items()
+        }
+        return {
+            **self.collection,
+            'features': [
+                {
+                    'type': 'Feature',
+                    'properties': {
+                        'VNAME': vname,
+                        **{k: column[i] for k, column in property_lists.items()}
+                    },
+                    'geometry': geometry_dict
+                }
+                for i, (vname, geometry_dict) in enumerate(
+                    zip(self.vnames, self.geometry_dicts)
+                )
+            ]
+        }
+
+    @property
+    def topojson_path(self) -> str:
+        return os.path.splitext(self.geojson_path)[0] + '.topojson'
+
+    def to_topojson(self, precision: int = 6) -> Dict[str, Any]:
+        """Make a TopoJSON Topology of the village borders, see
+        `build_topology`, with the VNAME as the only property of each
+        village. The properties of the layers are joined by VNAME from the
+        tables made by `to_attribute_table`. The topology is built once per
+        precision and shared by all the layers, do not modify it.
+        """
+        if precision in self._topojsons:
+            return self._topojsons[precision]
+        topology, geometries = build_topology(self.geometries, precision)
+        object_name = os.path.splitext(os.path.basename(self.geojson_path))[0]
+        self._topojsons[precision] = {
+            'type': topology['type'],
+            'bbox': topology['bbox'],
+            'transform': topology['transform'],
+            'objects': {
+                object_name: {
+                    'type': 'GeometryCollection',
+                    'geometries': [
+                        {**geometry, 'properties': {'VNAME': vname}}
+                        for vname, geometry in zip(self.vnames, geometries)
+                    ]
+                }
+            },
+            'arcs': topology['arcs'],
+        }
+        return self._topojsons[precision]
+
+    def to_attribute_table(
+            self,
+            property_columns: Dict[str, Sequence[Any]]) -> Dict[str, Any]:
+        """Make a table of the given columns, each aligned with `vnames`,
+        with one row per VNAME, like `{"key": "VNAME", "fields": [...],
+        "rows": {VNAME: [...]}}`. The villages with the same VNAME must have
+        the same values.
+        """
+        assert all(
+            len(column) == len(self.vnames)
+            for column in property_columns.values()
+        )
+        property_lists = [list(column) for column in property_columns.values()]
+        rows: Dict[str, list] = dict()
+        for i, vname in enumerate(self.vnames):
+            row = [column[i] for column in property_lists]
+            if vname in rows and json.dumps(rows[vname]) != json.dumps(row):
+                raise ValueError(
+                    f'Villages named {vname} have different properties'
+                )
+            rows[vname] = row
+        return {
+            'key': 'VNAME',
+            'fields': list(property_columns),
+            'rows': rows,
+        }
@@ -0,0 +1,70 @@
+import argparse
+from typing import Dict, List, Tuple
+
+from utils import *
+
+def get_component_queries() -> List[Tuple[str, str]]:
+    """Return `(component index, query)` of every query_chart and
+    query_history registered in the manager DB.
+    """
+    with get_manager_engine().connect() as conn:
+        rows = conn.execute(text(
+            'SELECT index, query_chart, query_history FROM components'
+        )).all()
+    component_queries = []
+    for index, query_chart, query_history in rows:
+        for query in (query_chart, query_history):
+            if query is not None and query.strip() != '':
+                component_queries.append((index, query))
+    return component_queries
+
+def main(create: bool, min_rows: int) -> None:
+    now = datetime.now(tz=pytz.timezone('Asia/Taipei'))
+    time_format = '%Y-%m-%dT%H:%M:%S+08:00'
+    # a one year range, the same as a yearly history in the front end
+    time_from = (now - timedelta(days=365)).strftime(time_format)
+    time_to = now.strftime(time_format)
+
+    recommendations: Dict[Tuple[str, str, str], List[str]] = dict()
+    with get_data_engine().connect() as conn:
+        for index, query in get_component_queries():
+            try:
+                filled_query = fill_query_placeholders(query, time_from, time_to)
+                for recommendation in recommend_indexes(conn, filled_query):
+                    recommendations.setdefault(recommendation, []).append(index)
+            except (ValueError, DBAPIError) as e:
+                print(f'Cannot explain query of component {index}: {e}')
+                conn.rollback()
+
+        for (table_name, field_name, method), indices in recommendations.items():
+            row_count = conn.execute(text(
+                'SELECT GREATEST(reltuples, 0) FROM pg_class '
+                'WHERE oid = CAST(:table_name AS regclass)'
+            ), {'table_name': f'public.{table_name}'}).scalar_one()
+            print(
+                f'{method} index on {table_name}({field_name}) '
+                f'for {", ".join(sorted(set(indices)))}, '
+                f'about {int(row_count)} rows'
+            )
+            # a sequential scan is the best plan for small tables anyway
+            if create and row_count >= min_rows:
+                create_index_clause(conn, table_name, field_name, method)
+                print(f'Created {method} index on {table_name}({field_name})')
+        conn.commit()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Explain the queries of the components and recommend '
+            'indexes for the columns that are filtered or sorted by a '
+            'sequential scan'
+    )
+    parser.add_argument(
+        '--create', action='store_true',
+        help='create the recommended indexes'
+    )
+    parser.add_argument(
+        '--min-rows', type=int, default=10000,
+        help='only create indexes on tables with at least this many rows'
+    )
+    args = parser.parse_args()
+    main(args.create, args.min_rows)
@@ -2,7 +2,6 @@ import io
 
 import sqlalchemy
 import pandas as pd
-import requests
 
 from utils import *
 
@@ -19,22 +18,20 @@ all_accidents_url = api_base + '行人'
 elder_accidents_url = api_base + '高齡者行人(含代步)'
 cross_accidents_url = api_base + '行人路口事故'
 
-respond_json = requests.request('GET', all_accidents_url).json()
+all_respond, elder_respond, cross_respond = fetch_all([
+    all_accidents_url, elder_accidents_url, cross_accidents_url
+])
 monthly_all_accidents = {
     entry['col'][0]: int(entry['value'])
-    for entry in respond_json
+    for entry in all_respond.json()
 }
-
-respond_json = requests.request('GET', elder_accidents_url).json()
 monthly_elder_accidents = {
     entry['col'][0]: int(entry['value'])
-    for entry in respond_json
+    for entry in elder_respond.json()
 }
-
-respond_json = requests.request('GET', cross_accidents_url).json()
 monthly_cross_accidents = {
     entry['col'][0]: int(entry['value'])
-    for entry in respond_json
+    for entry in cross_respond.json()
 }
 
 minguo_yms: List[str] = sorted(
@@ -110,40 +107,41 @@ history_query = (
     ORDER BY x_axis, y_axis ASC;
     """
 )
-with manager_engine.connect() as conn:
-    ComponentManager(
-        id=component_id,
-        index=component_index,
-        name='近一年歷月行人事故件數',
-        query_type='time',
-        query_chart=chart_query,
-        history_config={
-            'color': line_colors,
-            'range': ['fiveyear_ago']
-        },
-        map_config_ids=[],
-        map_filter=None,
-        time_from='current',
-        time_to=None,
-        update_freq=1,
-        update_freq_unit='month',
-        source='道安資訊查詢網',
-        short_desc='台北市近一年來歷月的行人交通事故件數',
-        long_desc='台北市近一年來歷月的行人交通事故總件數，與特殊子類別的件數',
-        use_case='通過查看行人交通事故的不同類別的佔比，了解台北當下的行人安全狀況的一個側面',
-        links=['https://roadsafety.tw/Dashboard/Custom'],
-        contributors=['王彥翔'],
-        query_history=history_query
-    ).insert(conn, on_conflict_do='update')
+registry = ComponentRegistry()
+registry.add(ComponentManager(
+    id=component_id,
+    index=component_index,
+    name='近一年歷月行人事故件數',
+    query_type='time',
+    query_chart=chart_query,
+    history_config={
+        'color': line_colors,
+        'range': ['fiveyear_ago']
+    },
+    map_config_ids=[],
+    map_filter=None,
+    time_from='current',
+    time_to=None,
+    update_freq=1,
+    update_freq_unit='month',
+    source='道安資訊查詢網',
+    short_desc='台北市近一年來歷月的行人交通事故件數',
+    long_desc='台北市近一年來歷月的行人交通事故總件數，與特殊子類別的件數',
+    use_case='通過查看行人交通事故的不同類別的佔比，了解台北當下的行人安全狀況的一個側面',
+    links=['https://roadsafety.tw/Dashboard/Custom'],
+    contributors=['王彥翔'],
+    query_history=history_query
+))
 
-    ComponentChartConfig(
-        index=component_index,
-        color=line_colors,
-        types=['TimelineSeparateChart'],
-        unit='件'
-    ).insert(conn, on_conflict_do='update')
+registry.add(ComponentChartConfig(
+    index=component_index,
+    color=line_colors,
+    types=['TimelineSeparateChart'],
+    unit='件'
+))
 
-    add_component_into_dashboard(
-        conn, component_id, 'hackathon-components'
-    )
+registry.add_to_dashboard('hackathon-components', component_id)
+
+with manager_engine.connect() as conn:
+    registry.sync(conn)
     conn.commit()
@@ -22,7 +22,8 @@ init_data_table_with_df(
     df=df,
     table_name=pm10_table_name,
     on_conflict_do='update',
-    constraint_fields=['x_axis']
+    constraint_fields=['x_axis'],
+    load_method='swap'
 )
 
 # Set Manager DB
@@ -32,79 +33,75 @@ pm10_query_chart = f'SELECT * FROM {pm10_table_name}'
 
 voronoi_component_id = 160
 voronoi_map_config_id = 160
-with manager_engine.connect() as conn:
-    ComponentManager(
-        id=voronoi_component_id,
-        index='pm10_voronoi',
-        name='pm10_voronoi',
-        query_type='two_d',
-        query_chart=pm10_query_chart,
-        map_config_ids=[voronoi_map_config_id],
-        map_filter=None,
-        time_from='static',
-        time_to=None,
-    ).insert(conn, on_conflict_do='update')
+registry = ComponentRegistry()
+registry.add(ComponentManager(
+    id=voronoi_component_id,
+    index='pm10_voronoi',
+    name='pm10_voronoi',
+    query_type='two_d',
+    query_chart=pm10_query_chart,
+    map_config_ids=[voronoi_map_config_id],
+    map_filter=None,
+    time_from='static',
+    time_to=None,
+))
 
-    ComponentChartConfig(
-        index='pm10_voronoi',
-        color=['#aabbcc'],
-        types=['RadarChart'],
-        unit=''
-    ).insert(conn, on_conflict_do='update')
+registry.add(ComponentChartConfig(
+    index='pm10_voronoi',
+    color=['#aabbcc'],
+    types=['RadarChart'],
+    unit=''
+))
 
-    # insert map config
-    MapConfig(
-        id=voronoi_map_config_id,
-        index='pm10_measurments',
-        title='PM10 Voronoi',
-        type='voronoi',
-        size=None,
-        icon=None,
-        paint={'line-color':'#99ffff'}
-    ).insert(conn, on_conflict_do='update')
+# insert map config
+registry.add(MapConfig(
+    id=voronoi_map_config_id,
+    index='pm10_measurments',
+    title='PM10 Voronoi',
+    type='voronoi',
+    size=None,
+    icon=None,
+    paint={'line-color':'#99ffff'}
+))
 
-    add_component_into_dashboard(
-        conn, voronoi_component_id, 'hackathon-components'
-    )
+registry.add_to_dashboard('hackathon-components', voronoi_component_id)
     
-    conn.commit()
 
 
 isoline_component_id = 161
 isoline_map_config_id = 161
-with manager_engine.connect() as conn:
-    ComponentManager(
-        id=isoline_component_id,
-        index='pm10_isoline',
-        name='pm10_isoline',
-        query_type='two_d',
-        query_chart=pm10_query_chart,
-        map_config_ids=[isoline_map_config_id],
-        map_filter=None,
-        time_from='static',
-        time_to=None,
-    ).insert(conn, on_conflict_do='update')
+registry.add(ComponentManager(
+    id=isoline_component_id,
+    index='pm10_isoline',
+    name='pm10_isoline',
+    query_type='two_d',
+    query_chart=pm10_query_chart,
+    map_config_ids=[isoline_map_config_id],
+    map_filter=None,
+    time_from='static',
+    time_to=None,
+))
 
-    ComponentChartConfig(
-        index='pm10_isoline',
-        color=['#aabbcc'],
-        types=['RadarChart'],
-        unit=''
-    ).insert(conn, on_conflict_do='update')
+registry.add(ComponentChartConfig(
+    index='pm10_isoline',
+    color=['#aabbcc'],
+    types=['RadarChart'],
+    unit=''
+))
 
-    # insert map config
-    MapConfig(
-        id=isoline_map_config_id,
-        index='pm10_measurments',
-        title='PM10 Isoline',
-        type='isoline',
-        size=None,
-        icon=None,
-        paint={'line-color':'#ffff99'}
-    ).insert(conn, on_conflict_do='update')
+# insert map config
+registry.add(MapConfig(
+    id=isoline_map_config_id,
+    index='pm10_measurments',
+    title='PM10 Isoline',
+    type='isoline',
+    size=None,
+    icon=None,
+    paint={'line-color':'#ffff99'}
+))
 
-    add_component_into_dashboard(
-        conn, isoline_component_id, 'hackathon-components'
-    )
+registry.add_to_dashboard('hackathon-components', isoline_component_id)
     
+with manager_engine.connect() as conn:
+    registry.sync(conn)
     conn.commit()
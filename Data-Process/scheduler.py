@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from typing import Dict, Optional, Set
+
+from utils import *
+
+# the ETL script that refreshes each component, by component index
+JOBS = {
+    'monthly_pedestrian_accidents': 'monthly_pedestrian_accidents.py',
+    'volcano_microseism': 'volcano.py',
+    'village_population_density': 'village_population_density.py',
+    'yearly_rent_subsidy': 'rent_subsidy_and_rental_housing_subleasing.py',
+    'yearly_rental_housing_subleasing': (
+        'rent_subsidy_and_rental_housing_subleasing.py'
+    ),
+    'village_vulnerability_index': 'earthquake_risk.py',
+    'village_earthquake_risk_index': 'earthquake_risk.py',
+}
+# the components with an update frequency that are refreshed otherwise,
+# the_clock is a live updater that runs forever, not a scheduled job
+UNSCHEDULED_COMPONENTS = {'the_clock'}
+
+FREQ_UNIT_SECONDS = {
+    'minute': 60,
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60,
+    'week': 7 * 24 * 60 * 60,
+    'month': 30 * 24 * 60 * 60,
+}
+
+DATA_PROCESS_DIR = os.path.dirname(os.path.abspath(__file__))
+# the unix time of the last start of every script, so that a restarted
+# scheduler keeps the schedule
+STATE_PATH = os.path.join(DATA_PROCESS_DIR, CACHE_DIR, 'scheduler_state.json')
+
+# the warnings already printed, a component is only reported once
+printed_warnings: Set[str] = set()
+
+def print_warning_once(message: str) -> None:
+    if message not in printed_warnings:
+        printed_warnings.add(message)
+        print(f'Warning: {message}')
+
+def get_job_periods() -> Dict[str, int]:
+    """Read `update_freq` and `update_freq_unit` of the components from the
+    manager DB and return the period in seconds of each ETL script. A script
+    that refreshes several components runs at the shortest of their periods.
+    Components with an update frequency but no script in `JOBS` are reported.
+    """
+    with get_manager_engine().connect() as conn:
+        rows = conn.execute(text("""
+            SELECT index, update_freq, update_freq_unit
+            FROM components
+            WHERE update_freq IS NOT NULL AND update_freq_unit IS NOT NULL
+        """)).all()
+    job_periods = dict()
+    for index, update_freq, update_freq_unit in rows:
+        if index in UNSCHEDULED_COMPONENTS:
+            continue
+        if index not in JOBS:
+            print_warning_once(
+                f'component {index} has an update frequency but no job in '
+                'JOBS, it is not refreshed'
+            )
+            continue
+        if update_freq_unit not in FREQ_UNIT_SECONDS or update_freq <= 0:
+            print_warning_once(
+                f'skip component {index}: invalid update frequency '
+                f'{update_freq} {update_freq_unit}'
+            )
+            continue
+        script = JOBS[index]
+        period = update_freq * FREQ_UNIT_SECONDS[update_freq_unit]
+        job_periods[script] = min(period, job_periods.get(script, period))
+    return job_periods
+
+def load_last_runs() -> Dict[str, float]:
+    if not os.path.exists(STATE_PATH):
+        return dict()
+    with open(STATE_PATH, 'r', encoding='utf-8') as state_file:
+        return json.load(state_file)
+
+def save_last_runs(last_runs: Dict[str, float]) -> None:
+    """Write the state file atomically, a crash leaves the old one."""
+    os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
+    with open(STATE_PATH + '.tmp', 'w', encoding='utf-8') as state_file:
+        json.dump(last_runs, state_file, indent=2)
+    os.replace(STATE_PATH + '.tmp', STATE_PATH)
+
+async def run_job(
+        script: str,
+        semaphore: asyncio.Semaphore,
+        timeout: float) -> None:
+    async with semaphore:
+        print(f'Start job {script}')
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, script, cwd=DATA_PROCESS_DIR
+        )
+        try:
+            returncode = await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            print(f'Job {script} killed after {timeout} seconds')
+            return
+        if returncode != 0:
+            print(f'Job {script} failed with exit code {returncode}')
+        else:
+            print(f'Job {script} finished')
+
+def get_next_start(
+        last_run: Optional[float],
+        period: int,
+        max_jitter: float) -> float:
+    """Return the unix time to start a script next, one period after its
+    last start, or now if it never ran. Every start is shifted by a random
+    jitter of up to 10% of the period (capped at `max_jitter`), so that jobs
+    with the same frequency do not all start at the same time.
+    """
+    jitter = min(period * 0.1, max_jitter)
+    if last_run is None:
+        return time.time() + random.uniform(0, jitter)
+    return last_run + period + random.uniform(-jitter, jitter)
+
+async def main(
+        max_parallel: int,
+        max_jitter: float,
+        run_now: bool,
+        cycle_seconds: float) -> None:
+    """Every cycle re-read the periods of the jobs, so that changes in the
+    manager DB apply without a restart, and start the jobs that are due.
+    The start of every job is saved in `STATE_PATH` and the next start is
+    one period after it, across restarts of the scheduler.
+    """
+    semaphore = asyncio.Semaphore(max_parallel)
+    last_runs = load_last_runs()
+    job_periods: Dict[str, int] = dict()
+    next_starts: Dict[str, float] = dict()
+    running: Dict[str, asyncio.Task] = dict()
+
+    async def run_scheduled_job(script: str, period: int) -> None:
+        start_time = time.time()
+        try:
+            await run_job(script, semaphore, timeout=period)
+        except OSError as error:
+            print(f'Job {script} could not start: {error}')
+        finally:
+            last_runs[script] = start_time
+            save_last_runs(last_runs)
+            next_starts.pop(script, None)
+            running.pop(script)
+
+    while True:
+        try:
+            new_job_periods = get_job_periods()
+        except DBAPIError as error:
+            print(f'Keep the job periods, cannot read them: {error}')
+            new_job_periods = job_periods
+        for script, period in new_job_periods.items():
+            if job_periods.get(script) != period:
+                print(f'Schedule {script} every {period} seconds')
+                next_starts.pop(script, None)
+        for script in set(job_periods) - set(new_job_periods):
+            print(f'Unschedule {script}')
+            next_starts.pop(script, None)
+        job_periods = new_job_periods
+
+        for script, period in job_periods.items():
+            if script in running:
+                continue
+            if script not in next_starts:
+                next_starts[script] = get_next_start(
+                    None if run_now else last_runs.get(script),
+                    period,
+                    max_jitter
+                )
+            if next_starts[script] <= time.time():
+                running[script] = asyncio.create_task(
+                    run_scheduled_job(script, period)
+                )
+        run_now = False
+        await asyncio.sleep(cycle_seconds)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Re-run the ETL scripts at the update frequency of '
+            'their components in the manager DB'
+    )
+    parser.add_argument(
+        '--max-parallel', type=int, default=2,
+        help='the maximum number of jobs running at the same time'
+    )
+    parser.add_argument(
+        '--max-jitter', type=float, default=300,
+        help='the maximum random shift of a job start in seconds'
+    )
+    parser.add_argument(
+        '--run-now', action='store_true',
+        help='run every job once at start instead of one period after its '
+            'last run'
+    )
+    parser.add_argument(
+        '--cycle', type=float, default=60,
+        help='the seconds between two reads of the job periods'
+    )
+    args = parser.parse_args()
+    asyncio.run(main(
+        args.max_parallel, args.max_jitter, args.run_now, args.cycle
+    ))
@@ -1,17 +1,49 @@
+import asyncio
+import atexit
+import codecs
+import csv
+from contextlib import contextmanager
+from contextvars import ContextVar
 from dataclasses import dataclass, field
-from datetime import datetime
+from datetime import datetime, timedelta
+import gzip
+import hashlib
 import io
 import json
-from typing import Any, Dict, List, ClassVar, Union, Literal, Optional
+import logging
+import os
+import re
+import resource
+import sys
+import threading
+import time
+from typing import (
+    Any, Callable, Dict, Iterable, Iterator, List, ClassVar, Tuple, Union,
+    Literal, Optional, Sequence, Set
+)
+from urllib.parse import urlsplit
 
+import numpy as np
 import pandas as pd
 import pytz
+import requests
+from requests.adapters import HTTPAdapter
+import shapely
+import shapely.geometry
 from sqlalchemy import (
-    create_engine, inspect, text,
-    URL, CursorResult, Connection
+    create_engine, event, inspect, text,
+    URL, CursorResult, Connection, Engine, QueuePool
 )
+from sqlalchemy.exc import DBAPIError
+from urllib3.util import Retry
+from geo_utils import VillageBaseLayer
 from get_env import *
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 ### TYPINGS
 
 DBBasicType = Optional[Union[int, float, str]]
@@ -36,8 +68,274 @@ BASIC_TYPES = (type(None), int, float, str)
 COMPO_TYPES = (list, dict, JsonList)
 
 
+### INSTRUMENTATION
+
+# where to append the stage records as json lines, stderr if empty
+STAGE_LOG_PATH = ENVS.get('DATA_PROCESS_STAGE_LOG_PATH', '')
+# the directory of the node exporter textfile collector, none if empty
+PROMETHEUS_TEXTFILE_DIR = ENVS.get('DATA_PROCESS_PROMETHEUS_TEXTFILE_DIR', '')
+
+stage_logger = logging.getLogger('data_process.stages')
+if not stage_logger.handlers:
+    stage_log_handler = (
+        logging.FileHandler(STAGE_LOG_PATH, encoding='utf-8')
+        if STAGE_LOG_PATH != '' else logging.StreamHandler()
+    )
+    stage_log_handler.setFormatter(logging.Formatter('%(message)s'))
+    stage_logger.addHandler(stage_log_handler)
+    stage_logger.setLevel(logging.INFO)
+    stage_logger.propagate = False
+
+@dataclass
+class StageStats:
+    name: str
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    rows_in: int = 0
+    rows_out: int = 0
+    bytes_fetched: int = 0
+    bytes_written: int = 0
+    db_round_trips: int = 0
+    # the peak RSS while the stage ran, including its inner stages
+    peak_rss_mb: float = 0.0
+
+current_stage: ContextVar[Optional[StageStats]] = ContextVar(
+    'current_stage', default=None
+)
+# the last stats of every stage of this process, for the textfile
+finished_stages: Dict[str, StageStats] = dict()
+# the number of open stages of every thread, the peak RSS is process-wide
+open_stage_counts: Dict[int, int] = dict()
+open_stage_counts_lock = threading.Lock()
+
+def reset_peak_rss() -> None:
+    """Reset the peak RSS of this process to its current RSS, so that
+    `get_peak_rss_mb` measures from now on. Only Linux can, elsewhere the
+    peak stays the one of the whole process.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+    except OSError:
+        pass
+
+def get_peak_rss_mb() -> float:
+    """Return the peak RSS of this process since `reset_peak_rss`."""
+    try:
+        with open('/proc/self/status', 'r') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def record_stage(
+        rows_in: int = 0,
+        rows_out: int = 0,
+        bytes_fetched: int = 0,
+        bytes_written: int = 0,
+        db_round_trips: int = 0) -> None:
+    """Add to the counters of the current stage, if there is one."""
+    stats = current_stage.get()
+    if stats is None:
+        return
+    stats.rows_in += rows_in
+    stats.rows_out += rows_out
+    stats.bytes_fetched += bytes_fetched
+    stats.bytes_written += bytes_written
+    stats.db_round_trips += db_round_trips
+
+@contextmanager
+def stage(name: str) -> Iterator[StageStats]:
+    """Measure a stage of a script. The wall and CPU time and the peak
+    memory are measured on exit, the counters are added with
+    `record_stage`, or by the helpers in this module that fetch, write or
+    query. A stage inside another one is named `outer/inner`, and its
+    bytes, round trips and peak memory also count for the outer stage.
+
+    The peak RSS is the one of the whole process. It is reset when a stage
+    starts, unless a stage of another thread is open, e.g. in `fetch_all`
+    or the `run_every_minute` updaters. The peak of overlapping stages is
+    then the one since the last reset, at least their own.
+
+    Each finished stage is logged as a json line by `stage_logger`, and the
+    last stats of every stage are written to the Prometheus textfile at exit
+    if `DATA_PROCESS_PROMETHEUS_TEXTFILE_DIR` is set.
+    """
+    parent = current_stage.get()
+    stats = StageStats(name if parent is None else f'{parent.name}/{name}')
+    # the peak is reset for every stage, so keep the one of the outer stage
+    # so far before
+    if parent is not None:
+        parent.peak_rss_mb = max(parent.peak_rss_mb, get_peak_rss_mb())
+    thread_id = threading.get_ident()
+    with open_stage_counts_lock:
+        if all(
+                count == 0 or other_thread_id == thread_id
+                for other_thread_id, count in open_stage_counts.items()):
+            reset_peak_rss()
+        open_stage_counts[thread_id] = open_stage_counts.get(thread_id, 0) + 1
+    token = current_stage.set(stats)
+    start_wall_time = time.perf_counter()
+    start_cpu_time = time.process_time()
+    try:
+        yield stats
+    finally:
+        stats.wall_seconds = time.perf_counter() - start_wall_time
+        stats.cpu_seconds = time.process_time() - start_cpu_time
+        stats.peak_rss_mb = max(stats.peak_rss_mb, get_peak_rss_mb())
+        with open_stage_counts_lock:
+            open_stage_counts[thread_id] -= 1
+            if open_stage_counts[thread_id] == 0:
+                del open_stage_counts[thread_id]
+        current_stage.reset(token)
+        if parent is not None:
+            parent.bytes_fetched += stats.bytes_fetched
+            parent.bytes_written += stats.bytes_written
+            parent.db_round_trips += stats.db_round_trips
+            parent.peak_rss_mb = max(parent.peak_rss_mb, stats.peak_rss_mb)
+        emit_stage(stats)
+
+def emit_stage(stats: StageStats) -> None:
+    stage_logger.info(json.dumps({
+        'script': os.path.basename(sys.argv[0]),
+        'time': datetime.now(tz=pytz.timezone('Asia/Taipei')).isoformat(),
+        **{
+            k: round(v, 4) if isinstance(v, float) else v
+            for k, v in vars(stats).items()
+        }
+    }, ensure_ascii=False))
+    finished_stages[stats.name] = stats
+
+def write_prometheus_textfile() -> None:
+    """Write the last stats of every stage as gauges into
+    `<script name>.prom`, replacing the file atomically.
+    """
+    script_name = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    lines = []
+    for field_name in StageStats.__dataclass_fields__:
+        if field_name == 'name':
+            continue
+        metric_name = f'data_process_stage_{field_name}'
+        lines.append(f'# TYPE {metric_name} gauge')
+        for stats in finished_stages.values():
+            stage_label = stats.name.replace('\\', '\\\\').replace('"', '\\"')
+            labels = f'script="{script_name}",stage="{stage_label}"'
+            lines.append(
+                f'{metric_name}{{{labels}}} {getattr(stats, field_name)}'
+            )
+    textfile_path = os.path.join(
+        PROMETHEUS_TEXTFILE_DIR, script_name + '.prom'
+    )
+    with open(textfile_path + '.tmp', 'w', encoding='utf-8') as textfile:
+        textfile.write('\n'.join(lines) + '\n')
+    os.replace(textfile_path + '.tmp', textfile_path)
+
+def write_prometheus_textfile_at_exit() -> None:
+    if len(finished_stages) != 0:
+        write_prometheus_textfile()
+
+if PROMETHEUS_TEXTFILE_DIR != '':
+    atexit.register(write_prometheus_textfile_at_exit)
+
+
 ### DATABASE CONNECTIONS
 
+# pool settings, can be overridden in docker/.env
+DB_POOL_SIZE = int(ENVS.get('DATA_PROCESS_DB_POOL_SIZE', 5))
+DB_POOL_MAX_OVERFLOW = int(ENVS.get('DATA_PROCESS_DB_POOL_MAX_OVERFLOW', 5))
+DB_POOL_TIMEOUT = float(ENVS.get('DATA_PROCESS_DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(ENVS.get('DATA_PROCESS_DB_POOL_RECYCLE', 3600))
+# in milliseconds, 0 means no timeout
+DB_STATEMENT_TIMEOUT = int(ENVS.get('DATA_PROCESS_DB_STATEMENT_TIMEOUT', 0))
+
+@dataclass
+class PoolStats:
+    connects: int = 0
+    checkouts: int = 0
+    checkins: int = 0
+    total_wait_seconds: float = 0.0
+    max_wait_seconds: float = 0.0
+
+class StatsQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a
+    connection, by timing the public `connect()`. The connections, checkouts
+    and checkins are counted by the pool event listeners of `get_engine`.
+    """
+    stats: PoolStats
+
+    def connect(self):
+        start_time = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            wait_seconds = time.perf_counter() - start_time
+            self.stats.total_wait_seconds += wait_seconds
+            self.stats.max_wait_seconds = max(
+                self.stats.max_wait_seconds, wait_seconds
+            )
+
+    def recreate(self):
+        # the listeners are copied to the new pool, and so are the stats
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+def count_pool_event(stats: PoolStats, field_name: str) -> Callable[..., None]:
+    def listener(*args) -> None:
+        setattr(stats, field_name, getattr(stats, field_name) + 1)
+    return listener
+
+ENGINES: Dict[URL, Engine] = dict()
+
+def get_engine(url: URL) -> Engine:
+    """Return the process-wide engine of the url, create it on first use so
+    that every caller shares one connection pool.
+    """
+    if url not in ENGINES:
+        connect_args = dict()
+        if DB_STATEMENT_TIMEOUT > 0:
+            connect_args['options'] = (
+                f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'
+            )
+        ENGINES[url] = create_engine(
+            url,
+            poolclass=StatsQueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_POOL_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=True,
+            connect_args=connect_args
+        )
+        pool = ENGINES[url].pool
+        pool.stats = PoolStats()
+        for event_name, field_name in [
+                ('connect', 'connects'),
+                ('checkout', 'checkouts'),
+                ('checkin', 'checkins')]:
+            event.listen(
+                pool, event_name, count_pool_event(pool.stats, field_name)
+            )
+        event.listen(
+            ENGINES[url],
+            'before_cursor_execute',
+            lambda *args: record_stage(db_round_trips=1)
+        )
+    return ENGINES[url]
+
+def get_pool_stats(engine: Engine) -> Dict[str, Union[int, float]]:
+    pool = engine.pool
+    return {
+        'size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow(),
+        **vars(pool.stats)
+    }
+
 MANAGER_DB_URL = URL.create(
     "postgresql+psycopg2",
     host="localhost",
@@ -48,7 +346,7 @@ MANAGER_DB_URL = URL.create(
 )
 
 def get_manager_engine():
-    return create_engine(MANAGER_DB_URL)
+    return get_engine(MANAGER_DB_URL)
 
 DATA_DB_URL = URL.create(
     "postgresql+psycopg2",
@@ -60,11 +358,136 @@ DATA_DB_URL = URL.create(
 )
 
 def get_data_engine():
-    return create_engine(DATA_DB_URL)
+    return get_engine(DATA_DB_URL)
+
+
+### HTTP
+
+# fetch settings, can be overridden in docker/.env
+HTTP_TIMEOUT = float(ENVS.get('DATA_PROCESS_HTTP_TIMEOUT', 30))
+HTTP_RETRIES = int(ENVS.get('DATA_PROCESS_HTTP_RETRIES', 3))
+HTTP_BACKOFF_FACTOR = float(ENVS.get('DATA_PROCESS_HTTP_BACKOFF_FACTOR', 0.5))
+HTTP_HOST_CONCURRENCY = int(ENVS.get('DATA_PROCESS_HTTP_HOST_CONCURRENCY', 4))
+# in seconds, the minimum gap between two request starts to the same host
+HTTP_HOST_MIN_INTERVAL = float(
+    ENVS.get('DATA_PROCESS_HTTP_HOST_MIN_INTERVAL', 0)
+)
+
+class FetchClient:
+    """HTTP client shared by the ETL scripts. It keeps one `requests.Session`
+    whose adapter pools keep-alive connections per host and retries failed
+    GETs with exponential backoff.
+
+    `fetch` runs a request in a thread so that many of them can be awaited
+    together. Each host allows at most `host_concurrency` requests at a
+    time, started at least `host_min_interval` seconds apart.
+    """
+    def __init__(
+            self,
+            timeout: float = HTTP_TIMEOUT,
+            retries: int = HTTP_RETRIES,
+            backoff_factor: float = HTTP_BACKOFF_FACTOR,
+            host_concurrency: int = HTTP_HOST_CONCURRENCY,
+            host_min_interval: float = HTTP_HOST_MIN_INTERVAL):
+        self.timeout = timeout
+        self.host_concurrency = host_concurrency
+        self.host_min_interval = host_min_interval
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=('GET', 'HEAD'),
+            respect_retry_after_header=True
+        )
+        adapter = HTTPAdapter(pool_maxsize=host_concurrency, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # asyncio primitives belong to one event loop, so the host limits
+        # are reset when used from a new one
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.host_semaphores: Dict[str, asyncio.Semaphore] = dict()
+        self.host_next_start: Dict[str, float] = dict()
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """Blocking GET that raises on an error status after the retries."""
+        kwargs.setdefault('timeout', self.timeout)
+        response = self.session.get(url, **kwargs)
+        response.raise_for_status()
+        record_stage(bytes_fetched=len(response.content))
+        return response
+
+    async def wait_for_host(self, host: str) -> None:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        start = max(now, self.host_next_start.get(host, now))
+        self.host_next_start[host] = start + self.host_min_interval
+        await asyncio.sleep(start - now)
+
+    async def fetch(self, url: str, **kwargs) -> requests.Response:
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.loop = loop
+            self.host_semaphores.clear()
+            self.host_next_start.clear()
+        host = urlsplit(url).netloc
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(
+                self.host_concurrency
+            )
+        async with self.host_semaphores[host]:
+            await self.wait_for_host(host)
+            return await asyncio.to_thread(self.get, url, **kwargs)
+
+    async def fetch_many(
+            self,
+            urls: List[str],
+            **kwargs) -> List[requests.Response]:
+        return await asyncio.gather(*[
+            self.fetch(url, **kwargs) for url in urls
+        ])
+
+FETCH_CLIENT: Optional[FetchClient] = None
+
+def get_fetch_client() -> FetchClient:
+    global FETCH_CLIENT
+    if FETCH_CLIENT is None:
+        FETCH_CLIENT = FetchClient()
+    return FETCH_CLIENT
+
+def fetch(url: str, **kwargs) -> requests.Response:
+    """GET one url with the shared client."""
+    return get_fetch_client().get(url, **kwargs)
+
+def fetch_all(urls: List[str], **kwargs) -> List[requests.Response]:
+    """GET the urls concurrently with the shared client and return the
+    responses in the same order. It takes about as long as the slowest
+    request instead of the sum of them.
+    """
+    return asyncio.run(get_fetch_client().fetch_many(urls, **kwargs))
 
 
 ### HELPER FUNCTIONS
 
+def on_conflict_clause(
+        field_names: List[str],
+        on_conflict_do: Literal['nothing', 'update'],
+        constraint_fields: Optional[List[str]] = None) -> str:
+    assert on_conflict_do in ('nothing', 'update')
+    if on_conflict_do == 'nothing':
+        return ' ON CONFLICT DO NOTHING'
+    assert (constraint_fields is not None
+        and isinstance(constraint_fields, list)
+        and len(constraint_fields) != 0
+    )
+    constraint_str = ','.join(constraint_fields)
+    set_str = ','.join([
+        f'{k}=EXCLUDED.{k}'
+        for k in field_names
+        if k not in constraint_fields
+    ])
+    return f' ON CONFLICT ({constraint_str}) DO UPDATE SET {set_str}'
+
 def insert_clause(
         conn: Connection,
         table_name: str,
@@ -74,23 +497,448 @@ def insert_clause(
     fields_str = ','.join((str(n) for n in row_dict.keys()))
     values_str = ','.join((pg_repr(n) for n in row_dict.values()))
     stmt = f'INSERT INTO {table_name} ({fields_str}) VALUES ({values_str})'
-    assert on_conflict_do in ('nothing', 'update')
-    if on_conflict_do == 'nothing':
-        stmt += f' ON CONFLICT DO NOTHING'
-    else:
-        assert (constraint_fields is not None
-            and isinstance(constraint_fields, list)
-            and len(constraint_fields) != 0
+    stmt += on_conflict_clause(
+        list(row_dict.keys()), on_conflict_do, constraint_fields
+    )
+    # print(stmt)
+    result = conn.execute(text(stmt))
+    # no stage of its own, it runs once per row, count for the caller's one
+    record_stage(rows_in=1, rows_out=result.rowcount)
+    return result
+
+def insert_many_clause(
+        conn: Connection,
+        table_name: str,
+        row_dicts: List[Dict[str, DBValueType]],
+        on_conflict_do: str = Literal['nothing', 'update'],
+        constraint_fields: Optional[List[str]] = None,
+        chunk_size: int = 1000) -> int:
+    """Insert rows with multi-row `INSERT ... VALUES` statements of at most
+    `chunk_size` rows each. The values are bound as parameters instead of
+    being inlined with `pg_repr`. Return the number of affected rows.
+
+    The rows are counted per chunk in the stage `insert <table_name>`, and
+    the engine events count one round trip per chunk.
+    """
+    if len(row_dicts) == 0:
+        return 0
+    field_names = [str(n) for n in row_dicts[0].keys()]
+    assert all(list(row_dict.keys()) == field_names for row_dict in row_dicts)
+    if on_conflict_do == 'update' and constraint_fields is not None:
+        # a row can only be updated once in a statement, so keep the last
+        # occurrence of every key like the row-by-row INSERTs would
+        row_dicts = list({
+            tuple(row_dict[k] for k in constraint_fields): row_dict
+            for row_dict in row_dicts
+        }.values())
+    fields_str = ','.join(field_names)
+    conflict_str = on_conflict_clause(
+        field_names, on_conflict_do, constraint_fields
+    )
+    rowcount = 0
+    with stage(f'insert {table_name}'):
+        for chunk_start in range(0, len(row_dicts), chunk_size):
+            chunk = row_dicts[chunk_start:chunk_start+chunk_size]
+            values_str = ','.join(
+                '('
+                + ','.join(f':v{i}_{j}' for j in range(len(field_names)))
+                + ')'
+                for i in range(len(chunk))
+            )
+            params = {
+                f'v{i}_{j}': pg_param(value)
+                for i, row_dict in enumerate(chunk)
+                for j, value in enumerate(row_dict.values())
+            }
+            stmt = (
+                f'INSERT INTO {table_name} ({fields_str}) VALUES {values_str}'
+            )
+            stmt += conflict_str
+            result = conn.execute(text(stmt), params)
+            record_stage(rows_in=len(chunk), rows_out=result.rowcount)
+            rowcount += result.rowcount
+    return rowcount
+
+# what `copy_df_rows` writes for NaN and None, so that empty strings are
+# not loaded as NULL. A string equal to the marker is loaded as NULL too.
+COPY_NULL_MARKER = r'\N'
+
+def copy_ready_df(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert the columns of a dataframe so that `COPY` loads the values
+    like `insert_clause` does: float columns holding only integers (int
+    columns with missing values) are written as integers, and arrays and
+    json values as the literals of `pg_param`.
+    """
+    columns = {}
+    for name, column in df.items():
+        if column.dtype == object:
+            column = pd.Series([
+                pg_param(v) if isinstance(v, COMPO_TYPES) else v
+                for v in column
+            ], index=column.index, dtype=object)
+        elif column.dtype.kind == 'f':
+            values = column.dropna()
+            if ((values == values.round()) & (values.abs() < 2 ** 63)).all():
+                column = column.astype('Int64')
+        columns[name] = column
+    return pd.DataFrame(columns, index=df.index)
+
+def copy_df_rows(conn: Connection, table_name: str, df: pd.DataFrame) -> None:
+    """Stream the rows of a dataframe into a table with `COPY FROM STDIN`.
+    Strings are always quoted and NaN and None are written as the quoted
+    `COPY_NULL_MARKER`, which `FORCE_NULL` loads as NULL.
+    """
+    fields_str = ','.join(str(n) for n in df.columns)
+    csv_buffer = io.StringIO()
+    copy_ready_df(df).to_csv(
+        csv_buffer,
+        header=False,
+        index=False,
+        na_rep=COPY_NULL_MARKER,
+        quoting=csv.QUOTE_NONNUMERIC
+    )
+    csv_buffer.seek(0)
+    with conn.connection.dbapi_connection.cursor() as cursor:
+        cursor.copy_expert(
+            f'COPY {table_name} ({fields_str}) FROM STDIN WITH (FORMAT csv, '
+            f"NULL '{COPY_NULL_MARKER}', FORCE_NULL ({fields_str}))",
+            csv_buffer
         )
+    # COPY runs on the raw cursor, which the engine events do not see
+    record_stage(
+        bytes_written=len(csv_buffer.getvalue().encode()), db_round_trips=1
+    )
+
+def create_table_with_df(
+        conn: Connection,
+        table_name: str,
+        df: pd.DataFrame,
+        dtype: Optional[Dict[str, Any]] = None) -> None:
+    """Create an empty table with the columns of a dataframe. The column
+    types are inferred from all the rows like `df.to_sql` does, not only
+    from the dtypes, so that e.g. object columns of ints are BIGINT.
+    """
+    conn.execute(text(
+        pd.io.sql.get_schema(df, table_name, con=conn, dtype=dtype)
+    ))
+
+def copy_df_into_temp_table(
+        conn: Connection,
+        table_name: str,
+        df: pd.DataFrame) -> str:
+    """Copy the rows of a dataframe into a new temporary table that has the
+    column types of the target table, and return the name of the temporary
+    table.
+    """
+    fields_str = ','.join(str(n) for n in df.columns)
+    tmp_table_name = 'tmp_copy_' + table_name.replace('.', '_')
+    conn.execute(text(f'DROP TABLE IF EXISTS {tmp_table_name}'))
+    conn.execute(text(
+        f'CREATE TEMP TABLE {tmp_table_name} AS '
+        f'SELECT {fields_str} FROM {table_name} WITH NO DATA'
+    ))
+    copy_df_rows(conn, tmp_table_name, df)
+    return tmp_table_name
+
+def copy_df_clause(
+        conn: Connection,
+        table_name: str,
+        df: pd.DataFrame,
+        on_conflict_do: str = Literal['nothing', 'update'],
+        constraint_fields: Optional[List[str]] = None) -> CursorResult[Any]:
+    """Bulk upsert the rows of a dataframe into an existing table. The rows
+    are streamed into a temporary table with `COPY FROM STDIN` and then
+    merged into the target table with one `INSERT ... SELECT ... ON
+    CONFLICT`, so the conflict semantics are the same as `insert_clause`.
+    """
+    field_names = [str(n) for n in df.columns]
+    fields_str = ','.join(field_names)
+    tmp_table_name = copy_df_into_temp_table(conn, table_name, df)
+    if on_conflict_do == 'update':
+        # a row can only be updated once in a statement, so keep the last
+        # occurrence of every key like the row-by-row INSERTs would
+        assert constraint_fields is not None
         constraint_str = ','.join(constraint_fields)
-        set_str = ','.join([
-            f'{k}=EXCLUDED.{k}'
-            for k in row_dict
-            if k not in constraint_fields
-        ])
-        stmt += f' ON CONFLICT ({constraint_str}) DO UPDATE SET {set_str}'
-    # print(stmt)
-    return conn.execute(text(stmt))
+        select_str = (
+            f'SELECT DISTINCT ON ({constraint_str}) {fields_str} '
+            f'FROM {tmp_table_name} ORDER BY {constraint_str}, ctid DESC'
+        )
+    else:
+        select_str = f'SELECT {fields_str} FROM {tmp_table_name}'
+    stmt = f'INSERT INTO {table_name} ({fields_str}) {select_str}'
+    stmt += on_conflict_clause(field_names, on_conflict_do, constraint_fields)
+    result = conn.execute(text(stmt))
+    conn.execute(text(f'DROP TABLE {tmp_table_name}'))
+    return result
+
+def delta_df_clause(
+        conn: Connection,
+        table_name: str,
+        df: pd.DataFrame,
+        constraint_fields: List[str],
+        delete_missing: bool = False) -> Dict[str, int]:
+    """Write only the difference between a dataframe and an existing table.
+    The rows are copied into a temporary table and compared with the table
+    by the key `constraint_fields`, then in set-based statements
+    - rows with a new key are inserted,
+    - rows whose other columns are distinct from the stored ones are
+      updated, so unchanged rows cause no write at all,
+    - if `delete_missing`, rows whose key is not in the dataframe are
+      deleted.
+    If a key occurs more than once, the last occurrence is used. Return the
+    number of inserted, updated, unchanged and deleted rows.
+    """
+    assert len(constraint_fields) != 0
+    field_names = [str(n) for n in df.columns]
+    fields_str = ','.join(field_names)
+    constraint_str = ','.join(constraint_fields)
+    value_fields = [n for n in field_names if n not in constraint_fields]
+    copy_table_name = copy_df_into_temp_table(conn, table_name, df)
+    src_table_name = 'tmp_delta_' + table_name.replace('.', '_')
+    conn.execute(text(f'DROP TABLE IF EXISTS {src_table_name}'))
+    conn.execute(text(
+        f'CREATE TEMP TABLE {src_table_name} AS '
+        f'SELECT DISTINCT ON ({constraint_str}) {fields_str} '
+        f'FROM {copy_table_name} ORDER BY {constraint_str}, ctid DESC'
+    ))
+    conn.execute(text(f'DROP TABLE {copy_table_name}'))
+    conn.execute(text(f'ANALYZE {src_table_name}'))
+    key_match_str = ' AND '.join(
+        f't.{n} = s.{n}' for n in constraint_fields
+    )
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'deleted': 0}
+    if len(value_fields) != 0:
+        target_row_str = 'ROW(' + ','.join(f't.{n}' for n in value_fields) + ')'
+        source_row_str = 'ROW(' + ','.join(f's.{n}' for n in value_fields) + ')'
+        counts['updated'] = conn.execute(text(
+            f'UPDATE {table_name} t '
+            f'SET ({",".join(value_fields)}) = {source_row_str} '
+            f'FROM {src_table_name} s '
+            f'WHERE {key_match_str} '
+            f'AND {target_row_str} IS DISTINCT FROM {source_row_str}'
+        )).rowcount
+    counts['inserted'] = conn.execute(text(
+        f'INSERT INTO {table_name} ({fields_str}) '
+        f'SELECT {fields_str} FROM {src_table_name} s '
+        f'WHERE NOT EXISTS '
+        f'(SELECT 1 FROM {table_name} t WHERE {key_match_str})'
+    )).rowcount
+    if delete_missing:
+        counts['deleted'] = conn.execute(text(
+            f'DELETE FROM {table_name} t WHERE NOT EXISTS '
+            f'(SELECT 1 FROM {src_table_name} s WHERE {key_match_str})'
+        )).rowcount
+    source_count = conn.execute(text(
+        f'SELECT COUNT(*) FROM {src_table_name}'
+    )).scalar_one()
+    counts['unchanged'] = source_count - counts['inserted'] - counts['updated']
+    conn.execute(text(f'DROP TABLE {src_table_name}'))
+    return counts
+
+def get_index_definitions(
+        conn: Connection,
+        table_name: str) -> List[Tuple[str, str]]:
+    """Return `(index name, definition)` of the indexes of a table, where
+    the definition leaves out the names of the index and of the table, so
+    that the same index of two tables has the same definition.
+    """
+    index_rows = conn.execute(text("""
+        SELECT i.relname, pg_get_indexdef(x.indexrelid)
+        FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+        WHERE x.indrelid = CAST(:table_name AS regclass)
+        ORDER BY i.relname
+    """), {'table_name': f'public.{table_name}'}).all()
+    index_definitions = []
+    for index_name, index_def in index_rows:
+        index_def_match = re.match(
+            r'(CREATE (?:UNIQUE )?INDEX )\S+( ON (?:ONLY )?)\S+( .*)',
+            index_def
+        )
+        index_definitions.append(
+            (index_name, index_def_match.group(1) + index_def_match.group(3))
+        )
+    return index_definitions
+
+def swap_in_shadow_table(
+        conn: Connection,
+        table_name: str,
+        shadow_table_name: str,
+        index_names: Optional[Dict[str, str]] = None) -> None:
+    """Replace a table with its filled shadow table, and rename the indexes
+    of the shadow table by `index_names`. The grants and the comment of the
+    replaced table are applied to the new one.
+
+    Views and foreign keys that depend on the table would block the DROP of
+    the replaced table, so they raise a ValueError before it.
+    """
+    grants = []
+    comment = None
+    if inspect(conn).has_table(table_name, schema='public'):
+        dependent_names = conn.execute(text("""
+            SELECT DISTINCT CAST(CAST(r.ev_class AS regclass) AS text)
+            FROM pg_depend d JOIN pg_rewrite r ON r.oid = d.objid
+            WHERE d.classid = CAST('pg_rewrite' AS regclass)
+                AND d.refobjid = CAST(:table_name AS regclass)
+                AND r.ev_class <> d.refobjid
+            UNION
+            SELECT conname || ' of ' || CAST(CAST(conrelid AS regclass) AS text)
+            FROM pg_constraint
+            WHERE contype = 'f'
+                AND confrelid = CAST(:table_name AS regclass)
+        """), {'table_name': f'public.{table_name}'}).scalars().all()
+        if len(dependent_names) != 0:
+            raise ValueError(
+                f'Cannot replace table {table_name}, it is used by '
+                + ', '.join(sorted(dependent_names))
+            )
+        grants = conn.execute(text("""
+            SELECT a.privilege_type,
+                CASE WHEN a.grantee = 0 THEN 'PUBLIC'
+                    ELSE quote_ident(pg_get_userbyid(a.grantee)) END,
+                a.is_grantable
+            FROM pg_class c, aclexplode(c.relacl) a
+            WHERE c.oid = CAST(:table_name AS regclass)
+                AND a.grantee <> c.relowner
+        """), {'table_name': f'public.{table_name}'}).all()
+        comment = conn.execute(text(
+            "SELECT obj_description(CAST(:table_name AS regclass), 'pg_class')"
+        ), {'table_name': f'public.{table_name}'}).scalar_one()
+    # the swap takes the exclusive lock only at the end of the transaction
+    conn.execute(text(f'DROP TABLE IF EXISTS {table_name}'))
+    conn.execute(text(
+        f'ALTER TABLE {shadow_table_name} RENAME TO {table_name}'
+    ))
+    # renaming the index of a constraint renames the constraint too
+    for shadow_index_name, index_name in (index_names or dict()).items():
+        conn.execute(text(
+            f'ALTER INDEX {shadow_index_name} RENAME TO {index_name}'
+        ))
+    for privilege, grantee, is_grantable in grants:
+        conn.execute(text(
+            f'GRANT {privilege} ON {table_name} TO {grantee}'
+            + (' WITH GRANT OPTION' if is_grantable else '')
+        ))
+    if comment is not None:
+        conn.execute(
+            text(f'COMMENT ON TABLE {table_name} IS :comment'),
+            {'comment': comment}
+        )
+
+def swap_df_clause(
+        conn: Connection,
+        table_name: str,
+        df: pd.DataFrame,
+        constraint_fields: Optional[List[str]] = None,
+        indexes: Optional[Dict[str, Literal['btree', 'brin']]] = None,
+        **to_sql_kwargs) -> None:
+    """Replace the whole content of a table with a dataframe. The rows are
+    copied into a shadow table `<table_name>__new`, which is then renamed
+    to the live one by `swap_in_shadow_table`. Readers of the table see
+    either the old or the new rows, never a partial load, and are only
+    blocked by the rename.
+
+    If the live table has all the columns of the dataframe, the shadow table
+    is made `LIKE` it, with its column types, defaults, constraints,
+    indexes and comments. Otherwise, e.g. on the first load or when the
+    columns change, it is made from the dataframe with only the primary key
+    of `constraint_fields`. The `indexes` of `init_data_table_with_df` that
+    the shadow table misses are created on it before the swap, so that
+    readers never see the new table without them.
+    """
+    shadow_table_name = table_name + '__new'
+    conn.execute(text(f'DROP TABLE IF EXISTS {shadow_table_name}'))
+    index_names = dict()
+    if (
+            inspect(conn).has_table(table_name, schema='public')
+            and set(map(str, df.columns))
+                <= set(get_table_columns(conn, table_name))):
+        conn.execute(text(
+            f'CREATE TABLE {shadow_table_name} '
+            f'(LIKE {table_name} INCLUDING ALL)'
+        ))
+        # the copied indexes get new names, give them back the live ones
+        live_index_names: Dict[str, List[str]] = dict()
+        for index_name, index_def in get_index_definitions(conn, table_name):
+            live_index_names.setdefault(index_def, []).append(index_name)
+        for shadow_index_name, index_def in get_index_definitions(
+                conn, shadow_table_name):
+            index_names[shadow_index_name] = (
+                live_index_names[index_def].pop(0)
+            )
+    else:
+        if inspect(conn).has_table(table_name, schema='public'):
+            print(
+                f'The columns of {table_name} changed, its constraints and '
+                'indexes other than the primary key and the requested ones '
+                'are not kept'
+            )
+        create_table_with_df(conn, shadow_table_name, df, **to_sql_kwargs)
+    copy_df_rows(conn, shadow_table_name, df)
+    has_primary_key = conn.execute(text("""
+        SELECT EXISTS (
+            SELECT FROM pg_constraint
+            WHERE conrelid = CAST(:table_name AS regclass) AND contype = 'p'
+        )
+    """), {'table_name': f'public.{shadow_table_name}'}).scalar_one()
+    if constraint_fields is not None and not has_primary_key:
+        pk_str = ','.join(constraint_fields)
+        conn.execute(text(
+            f'ALTER TABLE {shadow_table_name} '
+            f'ADD CONSTRAINT {shadow_table_name}_pkey PRIMARY KEY ({pk_str})'
+        ))
+        index_names[f'{shadow_table_name}_pkey'] = f'{table_name}_pkey'
+    for field_name, method in (indexes or dict()).items():
+        index_name = get_index_name(table_name, field_name, method)
+        if index_name not in index_names.values():
+            create_index_clause(conn, shadow_table_name, field_name, method)
+            index_names[
+                get_index_name(shadow_table_name, field_name, method)
+            ] = index_name
+    conn.execute(text(f'ANALYZE {shadow_table_name}'))
+    swap_in_shadow_table(conn, table_name, shadow_table_name, index_names)
+
+def materialize_query_clause(
+        conn: Connection,
+        result_table_name: str,
+        query: str) -> str:
+    """Save the result of a query into a result table, with an `ord` column
+    that keeps the order of the rows, and return a query that reads it back.
+    Use it for the chart of a static component, so that the dashboard reads
+    the precomputed rows instead of aggregating the data table every time.
+    The result table is replaced atomically with `swap_in_shadow_table`.
+    """
+    shadow_table_name = result_table_name + '__new'
+    conn.execute(text(f'DROP TABLE IF EXISTS {shadow_table_name}'))
+    conn.execute(text(
+        f'CREATE TABLE {shadow_table_name} AS '
+        f'SELECT ROW_NUMBER() OVER () AS ord, * FROM ({query}) AS result'
+    ))
+    swap_in_shadow_table(conn, result_table_name, shadow_table_name)
+    field_names = [
+        n for n in conn.execute(
+            text(f'SELECT * FROM {result_table_name} LIMIT 0')
+        ).keys()
+        if n != 'ord'
+    ]
+    return (
+        f'SELECT {",".join(field_names)} FROM {result_table_name} '
+        f'ORDER BY ord'
+    )
+
+def get_index_name(table_name: str, field_name: str, method: str) -> str:
+    return f'{table_name}_{field_name}_{method}_idx'
+
+def create_index_clause(
+        conn: Connection,
+        table_name: str,
+        field_name: str,
+        method: Literal['btree', 'brin'] = 'btree') -> None:
+    assert method in ('btree', 'brin')
+    conn.execute(text(
+        'CREATE INDEX IF NOT EXISTS '
+        f'{get_index_name(table_name, field_name, method)} '
+        f'ON {table_name} USING {method} ({field_name})'
+    ))
 
 def delete_clause(
         conn: Connection,
@@ -161,85 +1009,222 @@ def pg_repr(obj: DBValueType) -> str:
     # default
     return repr(obj)
 
+def pg_param(obj: DBValueType) -> Any:
+    """Convert a value into what is bound as a query parameter. NaN and the
+    missing values of pandas are NULL like in `copy_df_rows`, arrays and
+    json values are passed as the same text literals `pg_repr` produces.
+    """
+    if obj is pd.NA or (isinstance(obj, float) and np.isnan(obj)):
+        return None
+    assert type(obj) in BASIC_TYPES + COMPO_TYPES, type(obj)
+
+    if isinstance(obj, list):
+        types = set(type(elem) for elem in obj)
+        assert (
+            len(types) == 0 or len(types) == 1
+            and types.pop() in BASIC_TYPES
+        )
+        return '{' + ','.join(map(str, obj)) + '}'
+
+    if isinstance(obj, dict):
+        return json.dumps(obj)
+
+    if isinstance(obj, JsonList):
+        return json.dumps(obj._init_list)
+
+    return obj
+
 def init_data_table_with_df(
         df: pd.DataFrame,
         table_name: str,
         on_conflict_do: str = Literal['nothing', 'update'],
         constraint_fields: Optional[List[str]] = None,
-        **to_sql_kwargs):
+        load_method: Literal['copy', 'insert', 'delta', 'swap'] = 'copy',
+        delete_missing: bool = False,
+        indexes: Optional[Dict[str, Literal['btree', 'brin']]] = None,
+        **to_sql_kwargs) -> Optional[Dict[str, int]]:
     """Create new table with pandas dataframe. If table already exists,
-    insert rows in the dataframe one by one. This will not delete any
-    existing row.
-    """
-    print(f'Start initialize table {table_name}')
-    data_engine = get_data_engine()
-    if not inspect(data_engine).has_table(table_name, scheme='public'):
-        with data_engine.connect() as conn:
-            df.to_sql(
-                table_name,
-                conn,
-                index=False,
-                schema='public',
-                **to_sql_kwargs
+    upsert the rows in the dataframe. This will not delete any existing row
+    unless `load_method='delta'` and `delete_missing`, or
+    `load_method='swap'`.
+
+    With `load_method='copy'` the rows are streamed in with `COPY` and
+    merged in one statement, with `load_method='insert'` they are inserted
+    with batched multi-row INSERTs. With `load_method='delta'` only the
+    new and changed rows are written, see `delta_df_clause`, and the counts
+    of each kind of row are returned. With `load_method='swap'` the table is
+    replaced by the rows atomically, see `swap_df_clause`.
+
+    `indexes` maps column names to the index method to create on them if
+    missing, e.g. as recommended by `index_advisor.py`.
+    """
+    assert load_method in ('copy', 'insert', 'delta', 'swap')
+    assert not delete_missing or load_method == 'delta'
+    if load_method == 'delta':
+        assert constraint_fields is not None
+    with stage(f'init_data_table {table_name}'):
+        record_stage(rows_in=len(df))
+        print(f'Start initialize table {table_name}')
+        data_engine = get_data_engine()
+        counts = None
+        if load_method == 'swap':
+            print(f'Replace data table {table_name} with a shadow table')
+            with data_engine.connect() as conn:
+                swap_df_clause(
+                    conn=conn,
+                    table_name=table_name,
+                    df=df,
+                    constraint_fields=constraint_fields,
+                    indexes=indexes,
+                    **to_sql_kwargs
+                )
+                conn.commit()
+            record_stage(rows_out=len(df))
+        elif not inspect(data_engine).has_table(table_name, scheme='public'):
+            with data_engine.connect() as conn:
+                if load_method == 'insert':
+                    df.to_sql(
+                        table_name,
+                        conn,
+                        index=False,
+                        schema='public',
+                        **to_sql_kwargs
+                    )
+                else:
+                    create_table_with_df(conn, table_name, df, **to_sql_kwargs)
+                    copy_df_clause(
+                        conn=conn,
+                        table_name=table_name,
+                        df=df,
+                        on_conflict_do='nothing'
+                    )
+                if load_method == 'delta':
+                    counts = {
+                        'inserted': len(df), 'updated': 0,
+                        'unchanged': 0, 'deleted': 0
+                    }
+                if constraint_fields is not None:
+                    pk_str = ','.join(constraint_fields) 
+                    conn.execute(text(
+                        f'ALTER TABLE {table_name} ADD PRIMARY KEY ({pk_str})'
+                    ))
+                conn.commit()
+            record_stage(rows_out=len(df))
+        elif load_method == 'delta':
+            print(f'Data table {table_name} already exists, write the delta')
+            with data_engine.connect() as conn:
+                counts = delta_df_clause(
+                    conn=conn,
+                    table_name=table_name,
+                    df=df,
+                    constraint_fields=constraint_fields,
+                    delete_missing=delete_missing
+                )
+                conn.commit()
+            print(
+                f'Delta of data table {table_name}: '
+                + ', '.join(f'{v} {k}' for k, v in counts.items())
             )
-            if constraint_fields is not None:
-                pk_str = ','.join(constraint_fields) 
-                conn.execute(text(
-                    f'ALTER TABLE {table_name} ADD PRIMARY KEY ({pk_str})'
-                ))
-            conn.commit()
-    else:
-        print(f'Data table {table_name} already exists, use INSERTs')
-        with data_engine.connect() as conn:
-            for row_dict in df.to_dict(orient='records'):
-                insert_clause(
+            record_stage(
+                rows_out=counts['inserted'] + counts['updated'] + counts['deleted']
+            )
+        elif load_method == 'copy':
+            print(f'Data table {table_name} already exists, use COPY')
+            with data_engine.connect() as conn:
+                result = copy_df_clause(
+                    conn=conn,
+                    table_name=table_name,
+                    df=df,
+                    on_conflict_do=on_conflict_do,
+                    constraint_fields=constraint_fields
+                )
+                conn.commit()
+            record_stage(rows_out=result.rowcount)
+        else:
+            print(f'Data table {table_name} already exists, use INSERTs')
+            with data_engine.connect() as conn:
+                rowcount = insert_many_clause(
                     conn=conn,
                     table_name=table_name,
-                    row_dict=row_dict,
+                    row_dicts=df.to_dict(orient='records'),
                     on_conflict_do=on_conflict_do,
                     constraint_fields=constraint_fields
                 )
-            conn.commit()
-    print(f'Successfully initialized data table {table_name}')
+                conn.commit()
+            record_stage(rows_out=rowcount)
+        # a swap creates them on the shadow table
+        if indexes is not None and load_method != 'swap':
+            with data_engine.connect() as conn:
+                for field_name, method in indexes.items():
+                    create_index_clause(conn, table_name, field_name, method)
+                conn.commit()
+        print(f'Successfully initialized data table {table_name}')
+        return counts
 
 def init_data_table_with_csv_buffer(
         csv_buffer: bytes,
         table_name: str,
         on_conflict_do: str = Literal['nothing', 'update'],
         constraint_fields: Optional[List[str]] = None,
-        **to_sql_kwargs) -> None:
+        load_method: Literal['copy', 'insert', 'delta', 'swap'] = 'copy',
+        delete_missing: bool = False,
+        indexes: Optional[Dict[str, Literal['btree', 'brin']]] = None,
+        **to_sql_kwargs) -> Optional[Dict[str, int]]:
     csv_buffer_io = io.BytesIO(csv_buffer)
     df = pd.read_csv(csv_buffer_io)
-    init_data_table_with_df(
+    return init_data_table_with_df(
         df,
         table_name,
         on_conflict_do,
         constraint_fields,
+        load_method,
+        delete_missing,
+        indexes,
         **to_sql_kwargs
     )
 
+def append_dashboard_components_clause(
+        conn: Connection,
+        dashboard_components: Dict[str, List[int]]) -> List[str]:
+    """Append the component ids that are not in the `components` array of
+    each dashboard yet, keeping their given order. It is one `UPDATE`, so
+    concurrent calls cannot overwrite each other's appends. Return the
+    indices of the dashboards that changed.
+    """
+    dashboard_components = {
+        dashboard_index: list(dict.fromkeys(component_ids))
+        for dashboard_index, component_ids in dashboard_components.items()
+    }
+    return conn.execute(text("""
+        UPDATE dashboards d
+        SET components = COALESCE(d.components, '{}') || ARRAY(
+            SELECT CAST(c.id AS integer)
+            FROM jsonb_array_elements_text(x.ids) WITH ORDINALITY AS c(id, ord)
+            WHERE CAST(c.id AS integer) <> ALL(COALESCE(d.components, '{}'))
+            ORDER BY c.ord
+        )
+        FROM jsonb_each(CAST(:dashboard_components AS jsonb)) AS x(index, ids)
+        WHERE d.index = x.index
+            AND EXISTS (
+                SELECT 1 FROM jsonb_array_elements_text(x.ids) AS c(id)
+                WHERE CAST(c.id AS integer) <> ALL(COALESCE(d.components, '{}'))
+            )
+        RETURNING d.index
+    """), {
+        'dashboard_components': json.dumps(dashboard_components)
+    }).scalars().all()
+
 def add_component_into_dashboard(
         conn: Connection,
         component_id: int,
         dashboard_index: str) -> None:
-    original_components: List[int] = conn.execute(text(
-        f'SELECT index, components \
-            FROM dashboards \
-            WHERE index={pg_repr(dashboard_index)}'
-    )).first()[1]
-    if component_id in original_components:
+    if len(append_dashboard_components_clause(
+            conn, {dashboard_index: [component_id]})) == 0:
         print(
             f'Not adding id {component_id} into dashboard {dashboard_index}: '
             'already exists'
         )
         return
-    new_components = original_components + [component_id]
-    update_clause(
-        conn,
-        table_name='dashboards',
-        set_dict={'components': new_components},
-        where_dict={'index': dashboard_index}
-    )
     print(f'Success add id {component_id} into dashboard {dashboard_index}')
 
 def get_now_timestamp() -> str:
@@ -248,6 +1233,626 @@ def get_now_timestamp() -> str:
     ).strftime("%Y-%m-%d %H:%M:%S+00")
 
 
+### QUERY PLANS
+
+TIME_DATA_TYPES = (
+    'date', 'timestamp without time zone', 'timestamp with time zone'
+)
+
+def fill_query_placeholders(
+        query: str,
+        time_from: str,
+        time_to: str,
+        time_step_unit: str = 'month') -> str:
+    """Fill the `%s` placeholders of a component query the way the backend
+    does: 2 of them are the time range of `query_chart`, and every 3 of them
+    are the time step unit and the time range of `query_history`.
+    """
+    placeholder_count = query.count('%s')
+    if placeholder_count == 2:
+        values = [time_from, time_to]
+    elif placeholder_count % 3 == 0:
+        values = [time_step_unit, time_from, time_to] * (placeholder_count // 3)
+    else:
+        raise ValueError(f'Invalid number of placeholders: {placeholder_count}')
+    for value in values:
+        query = query.replace('%s', value, 1)
+    return query
+
+def iter_plan_nodes(plan: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    yield plan
+    for subplan in plan.get('Plans', []):
+        yield from iter_plan_nodes(subplan)
+
+def get_table_columns(conn: Connection, table_name: str) -> Dict[str, str]:
+    """Return the data type of every column of a table."""
+    return dict(conn.execute(text("""
+        SELECT column_name, data_type FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = :table_name
+    """), {'table_name': table_name}).all())
+
+def get_indexed_fields(conn: Connection, table_name: str) -> List[str]:
+    """Return the leading column of every index of a table."""
+    return conn.execute(text("""
+        SELECT a.attname
+        FROM pg_index x JOIN pg_attribute a
+            ON a.attrelid = x.indrelid AND a.attnum = x.indkey[0]
+        WHERE x.indrelid = CAST(:table_name AS regclass)
+    """), {'table_name': f'public.{table_name}'}).scalars().all()
+
+def iter_sort_key_scans(
+        sort_node: Dict[str, Any]) -> Iterator[Tuple[Dict[str, Any], str]]:
+    """Yield `(scan node, sort key)` for the keys of a sort node that belong
+    to one relation scanned below it. The keys are qualified by the alias of
+    the relation when the sort is over several ones, and an unqualified key
+    belongs to the only relation scanned below, if there is one.
+    """
+    scans = [
+        subnode for subnode in iter_plan_nodes(sort_node)
+        if 'Relation Name' in subnode
+    ]
+    scan_of_alias = {scan['Alias']: scan for scan in scans}
+    for sort_key in sort_node['Sort Key']:
+        aliases = set(re.findall(
+            r'\b(\w+)\.\w+', re.sub(r"'(?:[^']|'')*'", '', sort_key)
+        ))
+        if len(aliases) == 1 and aliases <= scan_of_alias.keys():
+            yield scan_of_alias[aliases.pop()], sort_key
+        elif len(aliases) == 0 and len(scans) == 1:
+            yield scans[0], sort_key
+
+def recommend_indexes(
+        conn: Connection,
+        query: str) -> List[Tuple[str, str, Literal['btree', 'brin']]]:
+    """Run `EXPLAIN` on a query and return `(table_name, field_name,
+    method)` for the columns that a sequential scan filters on, or that a
+    sort above a sequential scan orders by, and that no index leads with.
+    Time columns get a BRIN index, the others a btree index.
+
+    Columns are found by name in the filter and sort key expressions, so a
+    column renamed by an alias before it is sorted is not found.
+    """
+    plan = conn.execute(
+        text('EXPLAIN (FORMAT JSON) ' + query.strip().rstrip(';'))
+    ).scalar_one()[0]['Plan']
+    # expressions that scanning each table with an index could serve
+    table_expressions: Dict[str, List[str]] = dict()
+    for node in iter_plan_nodes(plan):
+        if node['Node Type'] == 'Seq Scan' and 'Filter' in node:
+            table_expressions.setdefault(node['Relation Name'], []).append(
+                node['Filter']
+            )
+        elif node['Node Type'] == 'Sort':
+            for scan, sort_key in iter_sort_key_scans(node):
+                if scan['Node Type'] == 'Seq Scan':
+                    table_expressions.setdefault(
+                        scan['Relation Name'], []
+                    ).append(sort_key)
+    recommendations = []
+    for table_name, expressions in table_expressions.items():
+        # drop the string literals so that they are not taken as names
+        expressions_str = re.sub(r"'(?:[^']|'')*'", '', ' '.join(expressions))
+        identifiers = set(re.findall(r'\b\w+\b', expressions_str))
+        indexed_fields = get_indexed_fields(conn, table_name)
+        for field_name, data_type in get_table_columns(conn, table_name).items():
+            if field_name in identifiers and field_name not in indexed_fields:
+                method = 'brin' if data_type in TIME_DATA_TYPES else 'btree'
+                recommendations.append((table_name, field_name, method))
+    return recommendations
+
+
+### GEOJSON
+
+def iter_geojson_feature_texts(
+        geojson_path: str,
+        chunk_size: int = 1 << 20) -> Iterator[Tuple[JsonDict, str]]:
+    """Yield the features of a GeoJSON FeatureCollection file one by one,
+    together with the raw text of each feature. The file is read in chunks
+    of `chunk_size` characters, so only the current feature is held in
+    memory.
+    """
+    decoder = json.JSONDecoder()
+    with open(geojson_path, 'r', encoding='utf-8') as geojson_file:
+        buffer = ''
+        while True:
+            chunk = geojson_file.read(chunk_size)
+            buffer += chunk
+            match = re.search(r'"features"\s*:\s*\[', buffer)
+            if match is not None:
+                buffer = buffer[match.end():]
+                break
+            if not chunk:
+                raise ValueError(f'{geojson_path} has no "features" array')
+            # keep the tail in case the key is cut by the chunk boundary
+            buffer = buffer[-32:]
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                if pos == len(buffer):
+                    raise json.JSONDecodeError('need more data', buffer, pos)
+                feature, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # the feature is cut by the chunk boundary, read more
+                chunk = geojson_file.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield feature, buffer[pos:end]
+            pos = end
+
+def iter_geojson_features(
+        geojson_path: str,
+        where: Optional[Callable[[JsonDict], bool]] = None
+        ) -> Iterator[JsonDict]:
+    """Yield the features of a GeoJSON file whose properties pass `where`."""
+    for feature, _text in iter_geojson_feature_texts(geojson_path):
+        if where is None or where(feature['properties']):
+            yield feature
+
+def parse_geojson_geometries(
+        feature_texts: Sequence[str],
+        features: Sequence[JsonDict],
+        drop_z: Optional[bool] = False) -> np.ndarray:
+    """Parse the geometries of GeoJSON features from their texts in bulk.
+
+    GEOS can not parse GeoJSON with z coordinates, so with `drop_z` the
+    geometries are built from the parsed features and made 2D instead, and
+    with `drop_z=None` only if parsing the texts fails.
+    """
+    if drop_z is None:
+        try:
+            return parse_geojson_geometries(feature_texts, features)
+        except shapely.errors.GEOSException:
+            return parse_geojson_geometries(feature_texts, features, True)
+    if drop_z:
+        return shapely.force_2d(np.array([
+            shapely.geometry.shape(feature['geometry']) for feature in features
+        ], dtype=object))
+    return shapely.from_geojson(np.array(feature_texts, dtype=object))
+
+def read_geojson_geometries(
+        geojson_path: str,
+        where: Optional[Callable[[JsonDict], bool]] = None,
+        property_names: Optional[List[str]] = None,
+        drop_z: bool = False,
+        batch_size: int = 10000) -> Tuple[np.ndarray, Dict[str, list]]:
+    """Read the geometries and the given properties of the features whose
+    properties pass `where`. Features without geometry are skipped. The
+    geometries are parsed with `parse_geojson_geometries`, `batch_size`
+    features at a time.
+    """
+    geometry_batches = []
+    features = []
+    feature_texts = []
+    property_names = property_names or []
+    properties = {name: [] for name in property_names}
+    for feature, feature_text in iter_geojson_feature_texts(geojson_path):
+        if feature['geometry'] is None:
+            continue
+        if where is not None and not where(feature['properties']):
+            continue
+        features.append(feature)
+        feature_texts.append(feature_text)
+        for name in property_names:
+            properties[name].append(feature['properties'][name])
+        if len(features) == batch_size:
+            geometry_batches.append(
+                parse_geojson_geometries(feature_texts, features, drop_z)
+            )
+            features = []
+            feature_texts = []
+    geometry_batches.append(
+        parse_geojson_geometries(feature_texts, features, drop_z)
+    )
+    return np.concatenate(geometry_batches), properties
+
+
+def quantize_coordinates(coordinates: Union[list, float], precision: int):
+    if isinstance(coordinates, list):
+        return [quantize_coordinates(c, precision) for c in coordinates]
+    return round(coordinates, precision)
+
+def quantize_geometry(geometry: Optional[JsonDict], precision: int):
+    if geometry is None:
+        return None
+    if geometry['type'] == 'GeometryCollection':
+        return {
+            **geometry,
+            'geometries': [
+                quantize_geometry(g, precision)
+                for g in geometry['geometries']
+            ]
+        }
+    return {
+        **geometry,
+        'coordinates': quantize_coordinates(
+            geometry['coordinates'], precision
+        )
+    }
+
+def write_geojson(
+        geojson: JsonDict,
+        geojson_path: str,
+        precision: Optional[int] = 6,
+        compress: Optional[List[Literal['gz', 'br']]] = None) -> None:
+    """Write a FeatureCollection for the front end. Coordinates are rounded
+    to `precision` decimal places (6 places is about 0.1 m) and the json is
+    written without whitespace. For each format in `compress`, a
+    pre-compressed sibling like `xxx.geojson.gz` is written too, so the web
+    server can send it as is. The input is not modified.
+
+    With `precision=None` any json, like a TopoJSON topology, is written
+    as is.
+    """
+    compress = compress or []
+    if precision is not None:
+        geojson = {
+            **geojson,
+            'features': [
+                {
+                    **feature,
+                    'geometry': quantize_geometry(
+                        feature['geometry'], precision
+                    )
+                }
+                for feature in geojson['features']
+            ]
+        }
+    geojson_bytes = json.dumps(
+        geojson, ensure_ascii=False, separators=(',', ':')
+    ).encode('utf-8')
+    with open(geojson_path, 'wb') as geojson_file:
+        geojson_file.write(geojson_bytes)
+    record_stage(bytes_written=len(geojson_bytes))
+    if 'gz' in compress:
+        gz_bytes = gzip.compress(geojson_bytes, compresslevel=9)
+        with open(geojson_path + '.gz', 'wb') as gz_file:
+            gz_file.write(gz_bytes)
+        record_stage(bytes_written=len(gz_bytes))
+    if 'br' in compress:
+        if brotli is None:
+            print(f'brotli is not installed, skip {geojson_path}.br')
+        else:
+            br_bytes = brotli.compress(geojson_bytes)
+            with open(geojson_path + '.br', 'wb') as br_file:
+                br_file.write(br_bytes)
+            record_stage(bytes_written=len(br_bytes))
+
+
+# the formats of the village layers in mapData, a comma separated list of
+# geojson and topojson
+VILLAGE_LAYER_FORMATS = ENVS.get(
+    'DATA_PROCESS_VILLAGE_LAYER_FORMATS', 'geojson'
+).split(',')
+
+# the village topologies written by this process, they are the same for
+# all the layers
+written_topojson_paths: Set[str] = set()
+
+def write_village_layer(
+        village_layer: VillageBaseLayer,
+        property_columns: Dict[str, Sequence[Any]],
+        geojson_path: str,
+        compress: Optional[List[Literal['gz', 'br']]] = None) -> JsonDict:
+    """Write the given property columns of the villages, each aligned with
+    `village_layer.vnames`, in the formats of `VILLAGE_LAYER_FORMATS`:
+
+    - geojson: a FeatureCollection at `geojson_path`
+    - topojson: an attribute table keyed by VNAME at `xxx.attributes.json`
+      beside it, plus the topology of the village borders shared by all the
+      layers, see `VillageBaseLayer.to_topojson`, written once per process
+
+    Return the FeatureCollection, e.g. for the vector tiles.
+    """
+    geojson = village_layer.to_geojson(property_columns)
+    if 'geojson' in VILLAGE_LAYER_FORMATS:
+        write_geojson(geojson, geojson_path, compress=compress)
+    if 'topojson' in VILLAGE_LAYER_FORMATS:
+        write_geojson(
+            village_layer.to_attribute_table(property_columns),
+            os.path.splitext(geojson_path)[0] + '.attributes.json',
+            precision=None,
+            compress=compress
+        )
+        if village_layer.topojson_path not in written_topojson_paths:
+            write_geojson(
+                village_layer.to_topojson(),
+                village_layer.topojson_path,
+                precision=None,
+                compress=compress
+            )
+            written_topojson_paths.add(village_layer.topojson_path)
+    return geojson
+
+
+### POPULATION
+
+# names that the civil affairs files misspell, by their correct name
+VILLAGE_NAME_FIXES = {
+    '糖?里': '糖蔀里',
+}
+
+def read_village_populations(
+        byte_chunks: Iterable[bytes],
+        encoding: str = 'big5') -> Tuple[np.ndarray, np.ndarray]:
+    """Parse the village population file of the civil affairs bureau and
+    return the village names and their total populations as two aligned
+    arrays. The bytes are decoded incrementally, so `byte_chunks` can be a
+    response stream and the file is never held as a list of lines.
+
+    The total of each village is on every third line starting from the 5th,
+    with the village name in the 4th column and the total in the 6th.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    names: List[str] = []
+    totals: List[int] = []
+    line_number = 0
+
+    def parse_line(line: str) -> None:
+        nonlocal line_number
+        if line_number >= 4 and (line_number - 4) % 3 == 0:
+            line_splits = line.split(',', maxsplit=6)
+            name = line_splits[3]
+            names.append(VILLAGE_NAME_FIXES.get(name, name))
+            totals.append(int(line_splits[5]))
+        line_number += 1
+
+    rest = ''
+    for chunk in byte_chunks:
+        lines = (rest + decoder.decode(chunk)).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            parse_line(line)
+    rest += decoder.decode(b'', final=True)
+    if rest != '':
+        parse_line(rest)
+    return np.array(names, dtype=object), np.array(totals, dtype=np.int64)
+
+def iter_file_chunks(
+        path: str,
+        chunk_size: int = 1 << 16) -> Iterator[bytes]:
+    with open(path, 'rb') as f:
+        yield from iter(lambda: f.read(chunk_size), b'')
+
+
+### LIVE UPDATERS
+
+async def sleep_until_next_minute() -> datetime:
+    now = datetime.now(tz=pytz.timezone('Asia/Taipei'))
+    next_minute = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    await asyncio.sleep((next_minute - now).total_seconds())
+    return next_minute
+
+async def run_every_minute(
+        update: Callable[[Connection, datetime], None],
+        engine: Engine) -> None:
+    """Call `update(conn, now)` now and then at every minute boundary, on
+    one connection kept open between the calls. The update runs in a thread,
+    so many live updaters can share one event loop, e.g.
+
+        async def main():
+            await asyncio.gather(
+                run_every_minute(update_a, engine),
+                run_every_minute(update_b, engine)
+            )
+
+        asyncio.run(main())
+    """
+    now = datetime.now(tz=pytz.timezone('Asia/Taipei'))
+    with engine.connect() as conn:
+        while True:
+            try:
+                await asyncio.to_thread(update, conn, now)
+            except DBAPIError as e:
+                if not e.connection_invalidated:
+                    raise
+                # the connection is reopened on its next use
+                print(f'Lost database connection, retry next minute: {e}')
+                conn.rollback()
+            now = await sleep_until_next_minute()
+
+def update_clock_hands(
+        conn: Connection,
+        table_name: str,
+        now: datetime,
+        hour_hand_length: int = 3,
+        minute_hand_length: int = 5) -> None:
+    """Move the hands of a clock table with columns (tick, hour_hand,
+    minute_hand) to `now` in a single UPDATE.
+    """
+    minute_tick = now.minute
+    hour_tick = (now.hour % 12) * 5 + now.minute // 12
+    conn.execute(
+        text(f"""
+            UPDATE {table_name} SET
+                minute_hand = CASE WHEN tick = :minute_tick
+                    THEN :minute_hand_length ELSE 0 END,
+                hour_hand = CASE WHEN tick = :hour_tick
+                    THEN :hour_hand_length ELSE 0 END
+            WHERE tick IN (:minute_tick, :hour_tick)
+                OR minute_hand <> 0 OR hour_hand <> 0
+        """),
+        {
+            'minute_tick': minute_tick,
+            'hour_tick': hour_tick,
+            'minute_hand_length': minute_hand_length,
+            'hour_hand_length': hour_hand_length,
+        }
+    )
+    conn.commit()
+    print(f'update clock: {now.hour:02d}:{now.minute:02d}')
+
+
+### CACHES
+
+CACHE_DIR = 'cache'
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+@dataclass
+class StageCache:
+    """Cache the json results of pipeline stages on disk. A result is keyed
+    by the stage name, the code version of the stage, the hashes of its
+    input files and the keys of the upstream stages it depends on, so that a
+    stage is recomputed exactly when one of them changes.
+    """
+    cache_dir: str = os.path.join(CACHE_DIR, 'stages')
+
+    def stage_key(
+            self,
+            stage_name: str,
+            version: int,
+            input_paths: List[str],
+            upstream_keys: List[str]) -> str:
+        key_source = json.dumps({
+            'stage': stage_name,
+            'version': version,
+            'inputs': {path: file_hash(path) for path in input_paths},
+            'upstreams': upstream_keys,
+        }, sort_keys=True)
+        return hashlib.sha256(key_source.encode()).hexdigest()
+
+    def run(
+            self,
+            stage_name: str,
+            compute: Callable[[], Any],
+            input_paths: Optional[List[str]] = None,
+            upstream_keys: Optional[List[str]] = None,
+            version: int = 1) -> Tuple[Any, str]:
+        """Return the result of the stage and its key. The cached result is
+        used if the key matches, otherwise `compute` is called and its
+        result is saved.
+        """
+        with stage(stage_name):
+            key = self.stage_key(
+                stage_name, version, input_paths or [], upstream_keys or []
+            )
+            cache_path = os.path.join(self.cache_dir, stage_name + '.json')
+            if os.path.exists(cache_path):
+                with open(cache_path, 'r', encoding='utf-8') as cache_file:
+                    cached = json.load(cache_file)
+                if cached['key'] == key:
+                    print(f'Use cached result of stage {stage_name}')
+                    return cached['value'], key
+            print(f'Compute stage {stage_name}')
+            value = compute()
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write to a temporary file first so that a crash never leaves a
+            # half-written result behind
+            with open(cache_path + '.tmp', 'w', encoding='utf-8') as cache_file:
+                json.dump({'key': key, 'value': value}, cache_file)
+            os.replace(cache_path + '.tmp', cache_path)
+            return value, key
+
+DATA_TAIPEI_DOWNLOAD_URL = (
+    'https://data.taipei/api/frontstage/tpeod/dataset/resource.download'
+)
+
+@dataclass
+class Download:
+    """The content of a url downloaded by `HttpCache`. `changed` is False if
+    the server answered 304 or the content hash equals the committed one.
+    """
+    content: bytes
+    changed: bool
+    cache: 'HttpCache'
+    key: str
+    meta: Dict[str, Optional[str]]
+
+    def iter_content(self, chunk_size: int = 1 << 16) -> Iterator[bytes]:
+        content_view = memoryview(self.content)
+        for start in range(0, len(content_view), chunk_size):
+            yield content_view[start:start+chunk_size]
+
+    def commit(self) -> None:
+        """Record this download as processed. Call it only after the content
+        has been loaded successfully, so that a failed run is retried next
+        time instead of being skipped as unchanged.
+        """
+        self.cache.save(self.key, self.content, self.meta)
+
+@dataclass
+class HttpCache:
+    """Cache downloaded files on disk with their ETag, Last-Modified and
+    content hash, keyed by a name such as the data.taipei resource id. A
+    download sends a conditional GET, so the server can answer 304 without
+    the body when nothing changed.
+    """
+    cache_dir: str = os.path.join(CACHE_DIR, 'http')
+
+    def paths(self, key: str) -> Tuple[str, str]:
+        return (
+            os.path.join(self.cache_dir, key + '.json'),
+            os.path.join(self.cache_dir, key + '.data')
+        )
+
+    def load_meta(self, key: str) -> Optional[Dict[str, Optional[str]]]:
+        meta_path, content_path = self.paths(key)
+        if not os.path.exists(meta_path) or not os.path.exists(content_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as meta_file:
+            return json.load(meta_file)
+
+    def save(
+            self,
+            key: str,
+            content: bytes,
+            meta: Dict[str, Optional[str]]) -> None:
+        meta_path, content_path = self.paths(key)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # the content goes first, the meta file marks the entry as complete
+        with open(content_path + '.tmp', 'wb') as content_file:
+            content_file.write(content)
+        os.replace(content_path + '.tmp', content_path)
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def download(self, key: str, url: str) -> Download:
+        cached_meta = self.load_meta(key)
+        headers = dict()
+        if cached_meta is not None:
+            if cached_meta['etag'] is not None:
+                headers['If-None-Match'] = cached_meta['etag']
+            if cached_meta['last_modified'] is not None:
+                headers['If-Modified-Since'] = cached_meta['last_modified']
+        response = fetch(url, headers=headers)
+        if response.status_code == 304 and cached_meta is not None:
+            print(f'Download {key} not modified')
+            with open(self.paths(key)[1], 'rb') as content_file:
+                content = content_file.read()
+            return Download(content, False, self, key, cached_meta)
+        content = response.content
+        meta = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'sha256': hashlib.sha256(content).hexdigest(),
+        }
+        changed = (
+            cached_meta is None or cached_meta['sha256'] != meta['sha256']
+        )
+        if not changed:
+            print(f'Download {key} has the same content hash')
+            # the content was committed already, only refresh the validators
+            self.save(key, content, meta)
+        return Download(content, changed, self, key, meta)
+
+    def download_data_taipei(self, rid: str) -> Download:
+        return self.download(rid, f'{DATA_TAIPEI_DOWNLOAD_URL}?rid={rid}')
+
+
 ### HELPER CLASSES
 
 @dataclass
@@ -395,3 +2000,126 @@ class ComponentManager(TableBase):
     table_name: ClassVar[str] = 'public.components'
     primary_key_field: ClassVar[str] = 'id'
 
+
+
+def registry_value_equal(value: DBValueType, stored_value: Any) -> bool:
+    """Compare a field of a definition with the `to_jsonb` form of the value
+    stored in the manager DB.
+    """
+    if isinstance(value, JsonList):
+        value = value._init_list
+    if isinstance(value, list) and isinstance(stored_value, list):
+        # arrays, either of numbers or of strings
+        return list(map(str, value)) == list(map(str, stored_value))
+    if isinstance(value, (list, dict)):
+        # a json value, or a list stored as text like `pg_param` does
+        if isinstance(stored_value, str):
+            return pg_param(value) == stored_value
+        return json.loads(json.dumps(value)) == stored_value
+    return value == stored_value
+
+@dataclass
+class ComponentRegistry:
+    """A batch of component, chart and map definitions and the dashboards
+    to show the components in.
+
+    `sync` reads the stored rows of all the definitions in one query and
+    upserts only the rows that differ, with one statement per table, then
+    appends the missing components to the dashboards in one statement. The
+    timestamps of the components are not compared, and `created_at` of a
+    stored component is kept.
+    """
+    components: List[ComponentManager] = field(default_factory=list)
+    charts: List[ComponentChartConfig] = field(default_factory=list)
+    maps: List[MapConfig] = field(default_factory=list)
+    dashboard_components: Dict[str, List[int]] = field(default_factory=dict)
+
+    def add(self, *rows: TableBase) -> None:
+        for row in rows:
+            if isinstance(row, ComponentManager):
+                self.components.append(row)
+            elif isinstance(row, ComponentChartConfig):
+                self.charts.append(row)
+            elif isinstance(row, MapConfig):
+                self.maps.append(row)
+            else:
+                raise TypeError(f'Cannot register {type(row)}')
+
+    def add_to_dashboard(self, dashboard_index: str, *component_ids: int):
+        self.dashboard_components.setdefault(dashboard_index, []).extend(
+            component_ids
+        )
+
+    def sync(self, conn: Connection) -> Dict[str, int]:
+        """Apply the definitions to the manager DB and return the number of
+        changed rows of each table. Commit `conn` afterwards to apply them
+        in one transaction.
+        """
+        rows_of_tables: List[List[TableBase]] = [
+            self.components, self.charts, self.maps
+        ]
+        stored_rows = conn.execute(text("""
+            SELECT 0, to_jsonb(t) FROM components t
+            WHERE id = ANY(:component_ids)
+            UNION ALL
+            SELECT 1, to_jsonb(t) FROM component_charts t
+            WHERE index = ANY(:chart_indices)
+            UNION ALL
+            SELECT 2, to_jsonb(t) FROM component_maps t
+            WHERE id = ANY(:map_ids)
+        """), {
+            'component_ids': [row.id for row in self.components],
+            'chart_indices': [row.index for row in self.charts],
+            'map_ids': [row.id for row in self.maps],
+        }).all()
+        stored_of_tables: List[Dict[Any, Dict[str, Any]]] = [
+            dict(), dict(), dict()
+        ]
+        for table_number, stored_row in stored_rows:
+            table_row_class = type(rows_of_tables[table_number][0])
+            stored_of_tables[table_number][
+                stored_row[table_row_class.primary_key_field]
+            ] = stored_row
+
+        changed_counts = dict()
+        for rows, stored_of_pk in zip(rows_of_tables, stored_of_tables):
+            if len(rows) == 0:
+                continue
+            changed_row_dicts = []
+            for row in rows:
+                row_dict = vars(row).copy()
+                stored_row = stored_of_pk.get(row_dict[row.primary_key_field])
+                if stored_row is not None:
+                    if all(
+                        registry_value_equal(value, stored_row.get(k))
+                        for k, value in row_dict.items()
+                        if k not in ('created_at', 'updated_at')
+                    ):
+                        continue
+                    if 'created_at' in row_dict:
+                        row_dict['created_at'] = stored_row['created_at']
+                changed_row_dicts.append(row_dict)
+            table_name = rows[0].table_name
+            insert_many_clause(
+                conn=conn,
+                table_name=table_name,
+                row_dicts=changed_row_dicts,
+                on_conflict_do='update',
+                constraint_fields=[rows[0].primary_key_field]
+            )
+            changed_counts[table_name] = len(changed_row_dicts)
+            print(
+                f'Success sync table {table_name}: '
+                f'{len(changed_row_dicts)} of {len(rows)} rows changed'
+            )
+
+        if len(self.dashboard_components) != 0:
+            changed_dashboards = append_dashboard_components_clause(
+                conn, self.dashboard_components
+            )
+            changed_counts['public.dashboards'] = len(changed_dashboards)
+            for dashboard_index in changed_dashboards:
+                print(
+                    f'Success add components into dashboard {dashboard_index}'
+                )
+        return changed_counts
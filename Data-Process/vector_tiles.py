@@ -0,0 +1,610 @@
+import argparse
+import gzip
+import json
+import math
+import os
+import shutil
+import struct
+from typing import (
+    Any, Callable, Dict, Iterator, List, Literal, Optional, Tuple
+)
+
+import numpy as np
+import shapely
+
+from utils import (
+    ENVS, GEOJSON_PATH, JsonDict, parse_geojson_geometries, record_stage, stage
+)
+
+# tiles are written when the directory is set, e.g. to the tiles directory
+# of mapData, which the front end serves at VECTOR_TILES_URL
+VECTOR_TILES_DIR = ENVS.get('DATA_PROCESS_VECTOR_TILES_DIR', '')
+VECTOR_TILES_URL = ENVS.get('DATA_PROCESS_VECTOR_TILES_URL', '/mapData/tiles')
+VECTOR_TILES_MIN_ZOOM = int(ENVS.get('DATA_PROCESS_VECTOR_TILES_MIN_ZOOM', 10))
+VECTOR_TILES_MAX_ZOOM = int(ENVS.get('DATA_PROCESS_VECTOR_TILES_MAX_ZOOM', 16))
+
+TILE_EXTENT = 4096
+# the margin around a tile in extent units, so that strokes and labels at
+# the tile borders are not cut
+TILE_BUFFER = 64
+# the simplification tolerance in extent units, 3 of 4096 is below a pixel
+SIMPLIFY_TOLERANCE = 3.0
+
+# the latitude where web mercator is a square
+MAX_LATITUDE = 85.0511287798
+
+
+### PROTOBUF
+
+# wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+
+def encode_varint(value: int) -> bytes:
+    """Encode a non-negative integer as a protobuf varint."""
+    varint = bytearray()
+    while value > 0x7f:
+        varint.append((value & 0x7f) | 0x80)
+        value >>= 7
+    varint.append(value)
+    return bytes(varint)
+
+VARINT_SHIFTS = np.arange(0, 35, 7, dtype=np.uint64)
+# the smallest values that take 2, 3, 4 and 5 groups
+VARINT_THRESHOLDS = np.uint64(1) << VARINT_SHIFTS[1:]
+
+def encode_varints(values: np.ndarray) -> bytes:
+    """Encode an array of uint32 as consecutive varints, e.g. the payload of
+    a packed repeated field.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    # a uint32 takes at most 5 groups of 7 bits
+    groups = (
+        (values[:, None] >> VARINT_SHIFTS) & np.uint64(0x7f)
+    ).astype(np.uint8)
+    group_counts = np.searchsorted(
+        VARINT_THRESHOLDS, values, side='right'
+    ) + 1
+    is_used = np.arange(5) < group_counts[:, None]
+    # every group but the last one of a value has the continuation bit
+    has_more = np.arange(5) < group_counts[:, None] - 1
+    groups[has_more] |= 0x80
+    return groups[is_used].tobytes()
+
+def zigzag(values: np.ndarray) -> np.ndarray:
+    """Map signed integers to unsigned ones, 0, -1, 1, -2 to 0, 1, 2, 3."""
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+def encode_key(field_number: int, wire_type: int) -> bytes:
+    return encode_varint((field_number << 3) | wire_type)
+
+def encode_varint_field(field_number: int, value: int) -> bytes:
+    return encode_key(field_number, VARINT) + encode_varint(value)
+
+def encode_bytes_field(field_number: int, payload: bytes) -> bytes:
+    return (
+        encode_key(field_number, LENGTH_DELIMITED)
+        + encode_varint(len(payload))
+        + payload
+    )
+
+def encode_packed_field(field_number: int, values: np.ndarray) -> bytes:
+    return encode_bytes_field(field_number, encode_varints(values))
+
+
+### MVT ENCODING
+
+# https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+
+# geometry types of a feature, by the dimension of the geometry
+GEOMETRY_TYPES = {0: 1, 1: 2, 2: 3}
+
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+
+def command(command_id: int, count: int) -> int:
+    return (command_id & 0x7) | (count << 3)
+
+def encode_geometry(
+        geometry: shapely.Geometry,
+        dimension: int) -> Optional[np.ndarray]:
+    """Encode a geometry in integer tile coordinates as the command
+    integers of a feature, None if nothing of it is left. Parts with another
+    dimension than the feature are skipped, as are repeated points and the
+    paths that collapsed to a point or a line when rounded to the grid.
+
+    Exterior rings are written with a positive area and interior rings with
+    a negative one, which is clockwise and counterclockwise respectively as
+    the y axis of the tile points down.
+    """
+    parts = shapely.get_parts(geometry)
+    parts = parts[
+        (shapely.get_dimensions(parts) == dimension) & ~shapely.is_empty(parts)
+    ]
+    if len(parts) == 0:
+        return None
+    if dimension == 0:
+        coords = shapely.get_coordinates(parts).astype(np.int64)
+        if len(coords) == 0:
+            return None
+        return np.concatenate([
+            [command(MOVE_TO, len(coords))],
+            zigzag(np.diff(coords, axis=0, prepend=[[0, 0]])).ravel()
+        ])
+
+    is_ring = dimension == 2
+    if is_ring:
+        paths, polygon_indices = shapely.get_rings(parts, return_index=True)
+    else:
+        paths = parts
+    coords, path_indices = shapely.get_coordinates(paths, return_index=True)
+    coords = coords.astype(np.int64)
+    is_path_start = np.ones(len(coords), dtype=bool)
+    is_path_start[1:] = path_indices[1:] != path_indices[:-1]
+    is_kept = np.ones(len(coords), dtype=bool)
+    # drop the closing points, ClosePath returns to the start of a ring
+    if is_ring:
+        is_kept[:-1] = ~is_path_start[1:]
+        is_kept[-1] = False
+    # drop the points that did not move from the previous point kept, the
+    # closing point dropped above is the one before each ring start
+    is_kept[1:] &= (
+        np.any(coords[1:] != coords[:-1], axis=1) | is_path_start[1:]
+    )
+    coords, path_indices = coords[is_kept], path_indices[is_kept]
+    path_lengths = np.bincount(path_indices, minlength=len(paths))
+    path_starts = np.cumsum(path_lengths) - path_lengths
+
+    if is_ring:
+        # the last point of a ring can still equal its first one
+        path_ends = path_starts + path_lengths - 1
+        is_closed_twice = (path_lengths > 1) & np.all(
+            coords[np.maximum(path_ends, 0)] == coords[path_starts], axis=1
+        )
+        coords = np.delete(coords, path_ends[is_closed_twice], axis=0)
+        path_indices = np.delete(path_indices, path_ends[is_closed_twice])
+        path_lengths[is_closed_twice] -= 1
+        path_starts = np.cumsum(path_lengths) - path_lengths
+
+        # signed areas by the surveyor's formula
+        next_points = np.arange(len(coords)) + 1
+        path_ends = path_starts + path_lengths - 1
+        next_points[path_ends[path_lengths > 0]] = (
+            path_starts[path_lengths > 0]
+        )
+        cross_products = (
+            coords[:, 0] * coords[next_points, 1]
+            - coords[next_points, 0] * coords[:, 1]
+        )
+        areas = np.bincount(
+            path_indices, weights=cross_products, minlength=len(paths)
+        ) / 2
+        is_exterior = np.ones(len(paths), dtype=bool)
+        is_exterior[1:] = polygon_indices[1:] != polygon_indices[:-1]
+        is_path_kept = (path_lengths >= 3) & (areas != 0)
+        # the holes of a collapsed polygon are meaningless
+        is_polygon_kept = np.zeros(len(parts), dtype=bool)
+        is_polygon_kept[polygon_indices[is_exterior]] = (
+            is_path_kept[is_exterior]
+        )
+        is_path_kept &= is_polygon_kept[polygon_indices]
+
+        # reverse the rings with the wrong winding order
+        is_reversed = (areas > 0) != is_exterior
+        point_reversed = is_reversed[path_indices]
+        positions = np.arange(len(coords)) - path_starts[path_indices]
+        order = np.where(
+            point_reversed,
+            path_starts[path_indices] + path_lengths[path_indices]
+                - 1 - positions,
+            np.arange(len(coords))
+        )
+        coords = coords[order]
+    else:
+        is_path_kept = path_lengths >= 2
+
+    is_point_kept = is_path_kept[path_indices]
+    coords, path_indices = coords[is_point_kept], path_indices[is_point_kept]
+    if len(coords) == 0:
+        return None
+    path_lengths = path_lengths[is_path_kept]
+    # renumber the paths kept from 0
+    path_indices = np.cumsum(is_path_kept)[path_indices] - 1
+
+    # each path is MoveTo(1) x y LineTo(n - 1) x y ... [ClosePath]
+    command_counts = 2 * path_lengths + 2 + is_ring
+    command_starts = np.cumsum(command_counts) - command_counts
+    commands = np.zeros(command_counts.sum(), dtype=np.uint64)
+    commands[command_starts] = command(MOVE_TO, 1)
+    commands[command_starts + 3] = (
+        LINE_TO | (path_lengths - 1) << 3
+    ).astype(np.uint64)
+    if is_ring:
+        commands[command_starts + command_counts - 1] = command(CLOSE_PATH, 1)
+    # the cursor carries over from the end of the previous path
+    deltas = zigzag(np.diff(coords, axis=0, prepend=[[0, 0]]))
+    positions = (
+        np.arange(len(coords)) - (np.cumsum(path_lengths) - path_lengths)[
+            path_indices
+        ]
+    )
+    delta_starts = (
+        command_starts[path_indices] + 1 + 2 * positions + (positions > 0)
+    )
+    commands[delta_starts] = deltas[:, 0]
+    commands[delta_starts + 1] = deltas[:, 1]
+    return commands
+
+def encode_value(value: Any) -> bytes:
+    if isinstance(value, str):
+        return encode_bytes_field(1, value.encode('utf-8'))
+    # bool before int, a bool is an int too
+    if isinstance(value, (bool, np.bool_)):
+        return encode_varint_field(7, int(value))
+    if isinstance(value, (int, np.integer)):
+        if value >= 0:
+            return encode_varint_field(5, int(value))
+        return encode_varint_field(6, int(zigzag(value)))
+    if isinstance(value, (float, np.floating)):
+        return encode_key(3, FIXED64) + struct.pack('<d', value)
+    # lists and dicts, like the other json properties of the front end
+    return encode_bytes_field(1, json.dumps(value, ensure_ascii=False).encode())
+
+class LayerEncoder:
+    """The features of one layer of one tile, with the key and value tables
+    that the tags of the features index into.
+    """
+    def __init__(self, name: str, extent: int = TILE_EXTENT):
+        self.name = name
+        self.extent = extent
+        self.features: List[bytes] = []
+        self.keys: Dict[str, int] = dict()
+        self.values: Dict[Tuple[type, Any], int] = dict()
+        self.encoded_values: List[bytes] = []
+
+    def tags(self, properties: JsonDict) -> List[int]:
+        tags = []
+        for k, v in properties.items():
+            # MVT has no null
+            if v is None or (isinstance(v, float) and math.isnan(v)):
+                continue
+            key_index = self.keys.setdefault(k, len(self.keys))
+            # by type too, so that 1, 1.0 and True are different values
+            value_key = (
+                type(v),
+                v if isinstance(v, (str, int, float))
+                    else json.dumps(v, ensure_ascii=False)
+            )
+            if value_key not in self.values:
+                self.values[value_key] = len(self.encoded_values)
+                self.encoded_values.append(encode_value(v))
+            tags += [key_index, self.values[value_key]]
+        return tags
+
+    def add_feature(
+            self,
+            feature_id: int,
+            properties: JsonDict,
+            geometry_type: int,
+            commands: np.ndarray) -> None:
+        self.features.append(
+            encode_varint_field(1, feature_id)
+            + encode_packed_field(2, self.tags(properties))
+            + encode_varint_field(3, geometry_type)
+            + encode_packed_field(4, commands)
+        )
+
+    def encode(self) -> bytes:
+        return b''.join([
+            encode_varint_field(15, 2), # version
+            encode_bytes_field(1, self.name.encode('utf-8')),
+            *[encode_bytes_field(2, feature) for feature in self.features],
+            *[encode_bytes_field(3, k.encode('utf-8')) for k in self.keys],
+            *[encode_bytes_field(4, v) for v in self.encoded_values],
+            encode_varint_field(5, self.extent),
+        ])
+
+
+### TILE PYRAMID
+
+def project_to_mercator(geometries: np.ndarray) -> np.ndarray:
+    """Project lon/lat geometries to web mercator scaled to the unit square,
+    with (0, 0) at the north-west corner of tile 0/0/0.
+    """
+    def transform(coords: np.ndarray) -> np.ndarray:
+        lon = coords[:, 0]
+        lat = np.radians(np.clip(coords[:, 1], -MAX_LATITUDE, MAX_LATITUDE))
+        return np.column_stack([
+            (lon + 180) / 360,
+            (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2
+        ])
+    return shapely.transform(geometries, transform)
+
+def covering_tiles(
+        bounds: np.ndarray,
+        zoom: int,
+        buffer: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return `(geometry indices, tile x, tile y)` of every tile whose
+    buffered box intersects the bounds of a geometry, for the bounds in the
+    unit square and `buffer` as a fraction of a tile.
+    """
+    tile_count = 1 << zoom
+    min_x, min_y, max_x, max_y = (
+        np.clip(
+            np.floor((bounds[:, i] * tile_count) + offset),
+            0, tile_count - 1
+        ).astype(np.int64)
+        for i, offset in enumerate([-buffer, -buffer, buffer, buffer])
+    )
+    widths = max_x - min_x + 1
+    counts = widths * (max_y - min_y + 1)
+    geometry_indices = np.repeat(np.arange(len(bounds)), counts)
+    # the position of each tile in the range of its geometry
+    positions = (
+        np.arange(counts.sum())
+        - np.repeat(np.cumsum(counts) - counts, counts)
+    )
+    tile_x = min_x[geometry_indices] + positions % widths[geometry_indices]
+    tile_y = min_y[geometry_indices] + positions // widths[geometry_indices]
+    return geometry_indices, tile_x, tile_y
+
+def tile_box(
+        zoom: int,
+        x: int,
+        y: int,
+        buffer: float) -> Tuple[float, float, float, float]:
+    """The box of a tile in the unit square, with `buffer` as a fraction of
+    a tile around it.
+    """
+    tile_size = 1 / (1 << zoom)
+    return (
+        (x - buffer) * tile_size,
+        (y - buffer) * tile_size,
+        (x + 1 + buffer) * tile_size,
+        (y + 1 + buffer) * tile_size,
+    )
+
+def to_tile_coordinates(
+        geometries: np.ndarray,
+        zoom: int,
+        x: int,
+        y: int,
+        extent: int) -> np.ndarray:
+    scale = (1 << zoom) * extent
+    return shapely.transform(
+        geometries,
+        lambda coords: (coords - [x / (1 << zoom), y / (1 << zoom)]) * scale
+    )
+
+def parse_geometries(features: List[JsonDict]) -> np.ndarray:
+    """Parse the geometries of GeoJSON features, dropping z coordinates."""
+    return parse_geojson_geometries(
+        [json.dumps(feature['geometry']) for feature in features],
+        features,
+        drop_z=None
+    )
+
+def iter_layer_tiles(
+        geojson: JsonDict,
+        layer_name: str,
+        min_zoom: int,
+        max_zoom: int,
+        property_names: Optional[List[str]] = None,
+        where: Optional[Callable[[JsonDict], bool]] = None,
+        extent: int = TILE_EXTENT,
+        buffer: int = TILE_BUFFER,
+        tolerance: float = SIMPLIFY_TOLERANCE
+        ) -> Iterator[Tuple[int, int, int, bytes]]:
+    """Cut a lon/lat FeatureCollection into Mapbox Vector Tiles of one
+    layer and yield `(z, x, y, tile)` for every tile that is not empty.
+
+    At each zoom the geometries are simplified with a tolerance of
+    `tolerance` extent units, clipped to the tile box plus `buffer` and
+    rounded to the integer grid of the tile. Only the features whose
+    properties pass `where` are kept, with only the properties in
+    `property_names`, or all of them if None.
+    """
+    # the position in the collection is the id of a feature
+    feature_ids = [
+        i for i, feature in enumerate(geojson['features'])
+        if feature['geometry'] is not None
+            and (where is None or where(feature['properties']))
+    ]
+    features = [geojson['features'][i] for i in feature_ids]
+    properties = [
+        {
+            k: v for k, v in (feature['properties'] or dict()).items()
+            if property_names is None or k in property_names
+        }
+        for feature in features
+    ]
+    geometries = project_to_mercator(parse_geometries(features))
+    dimensions = shapely.get_dimensions(geometries)
+    for zoom in range(min_zoom, max_zoom + 1):
+        zoom_geometries = shapely.simplify(
+            geometries,
+            tolerance / ((1 << zoom) * extent),
+            preserve_topology=True
+        )
+        geometry_indices, tile_x, tile_y = covering_tiles(
+            shapely.bounds(zoom_geometries), zoom, buffer / extent
+        )
+        order = np.lexsort((geometry_indices, tile_y, tile_x))
+        geometry_indices = geometry_indices[order]
+        tiles = np.column_stack([tile_x[order], tile_y[order]])
+        tile_starts = np.flatnonzero(
+            np.any(np.diff(tiles, axis=0, prepend=-1) != 0, axis=1)
+        )
+        tile_stops = np.append(tile_starts[1:], len(tiles))
+        for start, stop in zip(tile_starts, tile_stops):
+            x, y = (int(v) for v in tiles[start])
+            indices = geometry_indices[start:stop]
+            # clip before the transform, so that only the clipped pieces of
+            # large geometries are transformed
+            tile_geometries = shapely.set_precision(
+                to_tile_coordinates(
+                    shapely.clip_by_rect(
+                        zoom_geometries[indices],
+                        *tile_box(zoom, x, y, buffer / extent)
+                    ),
+                    zoom, x, y, extent
+                ),
+                grid_size=1.0,
+                # only round, making the output valid fails for invalid input
+                mode='pointwise'
+            )
+            layer = LayerEncoder(layer_name, extent)
+            for i, tile_geometry in zip(indices, tile_geometries):
+                commands = encode_geometry(tile_geometry, dimensions[i])
+                if commands is None:
+                    continue
+                layer.add_feature(
+                    feature_ids[i],
+                    properties[i],
+                    GEOMETRY_TYPES[dimensions[i]],
+                    commands
+                )
+            if len(layer.features) != 0:
+                yield zoom, x, y, encode_bytes_field(3, layer.encode())
+
+def write_vector_tiles(
+        geojson: JsonDict,
+        tiles_dir: str,
+        layer_name: str,
+        min_zoom: int = VECTOR_TILES_MIN_ZOOM,
+        max_zoom: int = VECTOR_TILES_MAX_ZOOM,
+        property_names: Optional[List[str]] = None,
+        where: Optional[Callable[[JsonDict], bool]] = None,
+        tile_url: Optional[str] = None,
+        compress: Optional[List[Literal['gz']]] = None) -> int:
+    """Write the tile pyramid of a FeatureCollection as
+    `tiles_dir/{z}/{x}/{y}.pbf`, see `iter_layer_tiles`, plus a TileJSON
+    `tiles.json` with `tile_url` as the url template of the tiles. With
+    `compress=['gz']` a pre-compressed `.pbf.gz` sibling is written too.
+
+    The pyramid is built next to `tiles_dir` and swapped in when complete,
+    so tiles of the old pyramid that are now empty do not linger. Return the
+    number of tiles written.
+    """
+    compress = compress or []
+    new_tiles_dir = tiles_dir.rstrip('/') + '.new'
+    old_tiles_dir = tiles_dir.rstrip('/') + '.old'
+    with stage(f'vector_tiles {layer_name}'):
+        shutil.rmtree(new_tiles_dir, ignore_errors=True)
+        tile_count = 0
+        for z, x, y, tile in iter_layer_tiles(
+                geojson, layer_name, min_zoom, max_zoom,
+                property_names, where):
+            tile_path = os.path.join(new_tiles_dir, str(z), str(x), f'{y}.pbf')
+            os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+            with open(tile_path, 'wb') as tile_file:
+                tile_file.write(tile)
+            record_stage(bytes_written=len(tile))
+            if 'gz' in compress:
+                gz_tile = gzip.compress(tile, compresslevel=9)
+                with open(tile_path + '.gz', 'wb') as gz_file:
+                    gz_file.write(gz_tile)
+                record_stage(bytes_written=len(gz_tile))
+            tile_count += 1
+        os.makedirs(new_tiles_dir, exist_ok=True)
+
+        fields = dict()
+        for feature in geojson['features']:
+            for k, v in (feature['properties'] or dict()).items():
+                if property_names is None or k in property_names:
+                    fields.setdefault(
+                        k, 'Number' if isinstance(v, (int, float))
+                            and not isinstance(v, bool) else 'String'
+                    )
+        bounds = shapely.total_bounds(parse_geometries([
+            feature for feature in geojson['features']
+            if feature['geometry'] is not None
+        ]))
+        with open(
+                os.path.join(new_tiles_dir, 'tiles.json'), 'w',
+                encoding='utf-8') as tilejson_file:
+            json.dump({
+                'tilejson': '3.0.0',
+                'name': layer_name,
+                'tiles': [tile_url or '{z}/{x}/{y}.pbf'],
+                'minzoom': min_zoom,
+                'maxzoom': max_zoom,
+                'bounds': [round(float(v), 6) for v in bounds],
+                'vector_layers': [{
+                    'id': layer_name,
+                    'fields': fields,
+                    'minzoom': min_zoom,
+                    'maxzoom': max_zoom,
+                }],
+            }, tilejson_file, ensure_ascii=False)
+
+        shutil.rmtree(old_tiles_dir, ignore_errors=True)
+        if os.path.exists(tiles_dir):
+            os.rename(tiles_dir, old_tiles_dir)
+        os.rename(new_tiles_dir, tiles_dir)
+        shutil.rmtree(old_tiles_dir, ignore_errors=True)
+        record_stage(rows_in=len(geojson['features']), rows_out=tile_count)
+    print(f'Wrote {tile_count} vector tiles of {layer_name} to {tiles_dir}')
+    return tile_count
+
+def write_map_data_tiles(
+        geojson: JsonDict,
+        layer_name: str,
+        property_names: Optional[List[str]] = None) -> None:
+    """Write the tile pyramid of a mapData layer into
+    `DATA_PROCESS_VECTOR_TILES_DIR/<layer name>`, if the directory is set.
+    """
+    if VECTOR_TILES_DIR == '':
+        return
+    write_vector_tiles(
+        geojson,
+        os.path.join(VECTOR_TILES_DIR, layer_name),
+        layer_name,
+        property_names=property_names,
+        tile_url=f'{VECTOR_TILES_URL}/{layer_name}/{{z}}/{{x}}/{{y}}.pbf',
+        compress=['gz']
+    )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Cut a GeoJSON layer into a z/x/y pyramid of Mapbox '
+            'Vector Tiles'
+    )
+    parser.add_argument('geojson_path', help='a lon/lat FeatureCollection')
+    parser.add_argument(
+        '--layer',
+        help='the layer name, the file name without extension by default'
+    )
+    parser.add_argument(
+        '--tiles-dir',
+        help='the output directory, DATA_PROCESS_VECTOR_TILES_DIR/<layer> '
+            'or the tiles directory of mapData by default'
+    )
+    parser.add_argument('--min-zoom', type=int, default=VECTOR_TILES_MIN_ZOOM)
+    parser.add_argument('--max-zoom', type=int, default=VECTOR_TILES_MAX_ZOOM)
+    parser.add_argument(
+        '--properties', nargs='+',
+        help='the properties to keep, all by default'
+    )
+    args = parser.parse_args()
+    layer_name = args.layer or os.path.splitext(
+        os.path.basename(args.geojson_path)
+    )[0]
+    tiles_dir = args.tiles_dir or os.path.join(
+        VECTOR_TILES_DIR or os.path.join(GEOJSON_PATH, 'tiles'), layer_name
+    )
+    with open(args.geojson_path, 'r', encoding='utf-8') as geojson_file:
+        geojson = json.load(geojson_file)
+    write_vector_tiles(
+        geojson,
+        tiles_dir,
+        layer_name,
+        min_zoom=args.min_zoom,
+        max_zoom=args.max_zoom,
+        property_names=args.properties,
+        tile_url=f'{VECTOR_TILES_URL}/{layer_name}/{{z}}/{{x}}/{{y}}.pbf',
+        compress=['gz']
+    )
@@ -1,10 +1,8 @@
-import io
-import json
 import sys
 
-import requests
-
 from utils import *
+from geo_utils import *
+from vector_tiles import *
 
 # Init Data DB
 
@@ -14,44 +12,28 @@ try:
 except IndexError:
     a = ''
 
+population_download = None
 if a != 'skip-init-data':
-    # get population_total
-    download_url = (
-        'https://data.taipei/api/frontstage/tpeod/dataset/resource.download'
-        '?rid=a92f4f08-9c3c-4122-98ce-00a3c38ece06'
+    # get population_total, skip the rest if the file did not change
+    population_download = HttpCache().download_data_taipei(
+        'a92f4f08-9c3c-4122-98ce-00a3c38ece06'
+    )
+    if not population_download.changed:
+        print('Population data unchanged, skip init data')
+
+if population_download is not None and population_download.changed:
+    village_names, village_totals = read_village_populations(
+        population_download.iter_content()
     )
-    response = requests.get(download_url, stream=True)
-    response.raw.decode_content = True
-    downloaded_file = io.BytesIO(response.content)
-    downloaded_file_bytes_lines = downloaded_file.readlines()
-    # we only want total population for each vil.
-    downloaded_file_bytes_lines = downloaded_file_bytes_lines[4::3]
-    # we only want the 3rd and 5th column: village name and total population
-    downloaded_file_bytes_lines_splited = [
-        line.split(b',', maxsplit=6)
-        for line in downloaded_file_bytes_lines
-    ]
-    village_population = dict([
-        (line_splits[3].decode('big5'), int(line_splits[5]))
-        for line_splits in downloaded_file_bytes_lines_splited
-    ])
-    village_population['糖蔀里'] = village_population['糖?里']
+    village_population = dict(zip(village_names, village_totals.tolist()))
     # print(village_population)
 
     # directly read from front end geojson
-    taipei_village_geojson_path = (
-        '../Taipei-City-Dashboard-FE/public/mapData/'
-        'taipei_village.geojson'
-    )
-    with open(taipei_village_geojson_path, 'r') as taipei_village_geojson_file:
-        taipei_village_geojson = json.load(taipei_village_geojson_file)
-    # print(taipei_village_geojson['features'][0])
-    village_area = {
-        feature['properties']['VNAME']: (
-            feature['properties']['AREA'] / 1_000_000 # from m^2 to km^2
-        )
-        for feature in taipei_village_geojson['features']
-    }
+    village_layer = VillageBaseLayer()
+    village_area = dict(zip(
+        village_layer.vnames,
+        (village_layer.properties['AREA'] / 1_000_000).tolist() # m^2 to km^2
+    ))
 
     assert '糖蔀里' in village_population
     assert '糖蔀里' in village_area
@@ -71,24 +53,31 @@ if a != 'skip-init-data':
         csv_buffer=csv_buffer,
         table_name=data_table_name,
         on_conflict_do='update',
-        constraint_fields=['village_name']
+        constraint_fields=['village_name'],
+        load_method='delta'
     )
 
-    taipei_village_pop_density_geojson = taipei_village_geojson
     # write new json data to Front End!
-    for feature in taipei_village_pop_density_geojson['features']:
-        vname = feature['properties']['VNAME']
-        feature['properties'] = {
-            'VNAME': vname,
-            'POP_DENSITY': village_population_density[vname]
-        }
     fe_pop_density_geojson_file_path = (
         '../Taipei-City-Dashboard-FE/public/mapData/'
         'taipei_village_pop_density.geojson'
     )
-    with open(fe_pop_density_geojson_file_path, 'w') as fe_geojson_file:
-        json.dump(taipei_village_pop_density_geojson, fe_geojson_file)
+    taipei_village_pop_density_geojson = write_village_layer(
+        village_layer,
+        {
+            'POP_DENSITY': [
+                village_population_density[vname]
+                for vname in village_layer.vnames
+            ]
+        },
+        fe_pop_density_geojson_file_path,
+        compress=['gz']
+    )
+    write_map_data_tiles(
+        taipei_village_pop_density_geojson, 'taipei_village_pop_density'
+    )
 
+    population_download.commit()
 
 # Set Manager DB
 manager_engine = get_manager_engine()
@@ -110,6 +99,12 @@ query_chart = ' UNION ALL '.join([
     for interval_name, range_begin, range_end in intervals
 
 ])
+# the data only changes when this script runs, so save the chart
+with get_data_engine().connect() as conn:
+    query_chart = materialize_query_clause(
+        conn, f'{data_table_name}_chart', query_chart
+    )
+    conn.commit()
 density_fill_color_stops = [
     [0,     '#505050'],
     [25000, '#909010'],
@@ -119,52 +114,53 @@ density_fill_color_stops = [
 component_id = 3
 component_index = 'village_population_density'
 map_config_id = 3
-with manager_engine.connect() as conn:
-    ComponentManager(
-        id=component_id,
-        index=component_index,
-        name='台北市各里戶籍人口密度',
-        query_type='two_d',
-        query_chart=query_chart,
-        map_config_ids=[map_config_id],
-        map_filter=None,
-        time_from='static',
-        time_to=None,
-        source=['臺北市民政局'],
-        short_desc='台北市各里戶籍人口密度',
-        long_desc='台北市各里戶籍人口密度',
-        use_case='可疊加於其他圖層上'
-    ).insert(conn, on_conflict_do='update')
-
-    ComponentChartConfig(
-        index=component_index,
-        color=['#c0c050'],
-        types=['ColumnChart'],
-        unit='個里'
-    ).insert(conn, on_conflict_do='update')
-
-    MapConfig(
-        id=map_config_id,
-        index='taipei_village_pop_density',
-        title='各里戶籍人口密度',
-        type='fill',
-        size=None,
-        icon=None,
-        paint={
-            # 'fill-color': '#abcdef',
-            'fill-color': {
-                'property': 'POP_DENSITY',
-                'stops': density_fill_color_stops
-            },
-            'fill-opacity': 0.3
+registry = ComponentRegistry()
+registry.add(ComponentManager(
+    id=component_id,
+    index=component_index,
+    name='台北市各里戶籍人口密度',
+    query_type='two_d',
+    query_chart=query_chart,
+    map_config_ids=[map_config_id],
+    map_filter=None,
+    time_from='static',
+    time_to=None,
+    source=['臺北市民政局'],
+    short_desc='台北市各里戶籍人口密度',
+    long_desc='台北市各里戶籍人口密度',
+    use_case='可疊加於其他圖層上'
+))
+
+registry.add(ComponentChartConfig(
+    index=component_index,
+    color=['#c0c050'],
+    types=['ColumnChart'],
+    unit='個里'
+))
+
+registry.add(MapConfig(
+    id=map_config_id,
+    index='taipei_village_pop_density',
+    title='各里戶籍人口密度',
+    type='fill',
+    size=None,
+    icon=None,
+    paint={
+        # 'fill-color': '#abcdef',
+        'fill-color': {
+            'property': 'POP_DENSITY',
+            'stops': density_fill_color_stops
         },
-        property=JsonList(
-            {'key': 'VNAME', 'name': '里名'},
-            {'key': 'POP_DENSITY', 'name': '戶籍人口密度'}
-        )
-    ).insert(conn, on_conflict_do='update')
-
-    add_component_into_dashboard(
-        conn, component_id, 'hackathon-components'
+        'fill-opacity': 0.3
+    },
+    property=JsonList(
+        {'key': 'VNAME', 'name': '里名'},
+        {'key': 'POP_DENSITY', 'name': '戶籍人口密度'}
     )
+))
+
+registry.add_to_dashboard('hackathon-components', component_id)
+
+with manager_engine.connect() as conn:
+    registry.sync(conn)
     conn.commit()
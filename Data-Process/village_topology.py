@@ -0,0 +1,84 @@
+import argparse
+import gzip
+import json
+import os
+from typing import List, Tuple
+
+from utils import *
+from geo_utils import *
+
+VILLAGE_LAYER_NAMES = [
+    'taipei_village_vulnerability',
+    'taipei_village_earthquake_risk_index',
+    'taipei_village_pop_density',
+    'taipei_village_disaster_risk_index',
+]
+
+def file_sizes(path: str) -> Tuple[int, int]:
+    """Return the bytes of a file and of its gzip sibling."""
+    gz_path = path + '.gz'
+    if os.path.exists(gz_path):
+        gz_size = os.path.getsize(gz_path)
+    else:
+        with open(path, 'rb') as f:
+            gz_size = len(gzip.compress(f.read(), compresslevel=9))
+    return os.path.getsize(path), gz_size
+
+def main(layer_names: List[str]) -> None:
+    village_layer = VillageBaseLayer()
+    geojson_sizes = []
+    topojson_paths = [village_layer.topojson_path]
+    for layer_name in layer_names:
+        geojson_path = os.path.join(GEOJSON_PATH, layer_name + '.geojson')
+        with open(geojson_path, 'r', encoding='utf-8') as geojson_file:
+            features = json.load(geojson_file)['features']
+        # the layers are made by VillageBaseLayer.to_geojson, so that the
+        # villages are in the same order
+        if [f['properties']['VNAME'] for f in features] != village_layer.vnames:
+            raise ValueError(
+                f'The villages of {layer_name} are not the ones of '
+                f'{village_layer.geojson_path}'
+            )
+        field_names = [
+            k for k in features[0]['properties'] if k != 'VNAME'
+        ]
+        attributes_path = os.path.join(
+            GEOJSON_PATH, layer_name + '.attributes.json'
+        )
+        write_geojson(
+            village_layer.to_attribute_table({
+                k: [feature['properties'][k] for feature in features]
+                for k in field_names
+            }),
+            attributes_path,
+            precision=None,
+            compress=['gz']
+        )
+        geojson_sizes.append(file_sizes(geojson_path))
+        topojson_paths.append(attributes_path)
+    write_geojson(
+        village_layer.to_topojson(),
+        village_layer.topojson_path,
+        precision=None,
+        compress=['gz']
+    )
+
+    topojson_sizes = [file_sizes(path) for path in topojson_paths]
+    for (name, sizes) in [
+            ('geojson', geojson_sizes), ('topojson', topojson_sizes)]:
+        print(
+            f'{name}: {sum(size for size, _ in sizes)} bytes, '
+            f'{sum(gz_size for _, gz_size in sizes)} bytes gzipped'
+        )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write the village topology and the attribute tables of '
+            'the village layers in mapData'
+    )
+    parser.add_argument(
+        'layer_names', nargs='*', default=VILLAGE_LAYER_NAMES,
+        help='the village layers in mapData, without .geojson'
+    )
+    args = parser.parse_args()
+    main(args.layer_names)